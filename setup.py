@@ -21,7 +21,14 @@ setup(
     entry_points={
         'console_scripts': [
             'stitches=stitches:main'
-        ]
+        ],
+        'stitches.tasks': [
+            'grass=stitches.tasks:grass',
+            'grass_batch=stitches.tasks:grass_batch',
+            'grass_blocks=stitches.tasks:grass_blocks',
+            'grass_link=stitches.tasks:grass_link',
+            'script=stitches.tasks:script',
+        ],
     },
     install_requires=[
         'colorful',
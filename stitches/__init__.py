@@ -16,3 +16,9 @@
 from .cli import main
 from .core import *  # pylint: disable=wildcard-import
 from .session import session
+from .session import scratch_mapset
+from .runner import Runner
+from .runner import RunResult
+from .runner import run
+from .runner import sweep
+from .runner import read_instances
@@ -18,7 +18,17 @@ try:
     from grass.script import setup as gsetup
     from grass.script import core as gcore
     from grass.pygrass.modules import Module
+    from grass.pygrass.modules import MultiModule
+    from grass.pygrass.modules import ParallelModuleQueue
+    from grass.pygrass.gis.region import Region
+    from grass.pygrass.raster import RasterRow
+    from grass.pygrass.raster.buffer import Buffer
 except ImportError:
     gsetup = None
     gcore = None
     Module = None
+    MultiModule = None
+    ParallelModuleQueue = None
+    Region = None
+    RasterRow = None
+    Buffer = None
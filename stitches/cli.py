@@ -19,50 +19,122 @@ Stitches.
 Usage:
   stitches [--gisdbase=<path>] [--location=<name>] [--mapset=<name>]
            [[--skip=<task>]... [--force] | --only=<task>]
-           [--log=<path>] [--verbose] [--nocolor]
+           [--invalidate=<resource>]... [--track-code]
+           [--log=<path>] [--verbose | --progress] [--explain] [--nocolor]
+           [--metrics=<path>] [--trace=<path> [--trace-format=<format>]]
+           [(--profile | --profile-task=<ref>...) [--profile-memory]]
+           [--scratch=<path>] [--stage=<path>]
            [--vars=<vars>] <pipeline>
+  stitches affected [--gisdbase=<path>] [--location=<name>] [--mapset=<name>]
+           [--vars=<vars>] <pipeline> <resource>...
+  stitches sweep [--gisdbase=<path>] [--location=<name>] [--mapset=<name>]
+           [--workers=<n>] [--force] [--log=<path>] [--nocolor]
+           [--vars=<vars>] <pipeline> <instances>
+
+Commands:
+  affected              List the tasks downstream of resources or files, with
+                        their durations estimated from previous runs.
+  sweep                 Run the pipeline for each set of variables in a CSV
+                        or JSONL file, each in its own mapset. The mapset
+                        name is formatted with the variables and an index
+                        (default: sweep_{index}).
 
 Options:
   -h --help             Show this screen.
   -v --verbose          Show more output.
+  --progress            Show more output, with estimated time remaining.
+  --explain             Show why each task is run, or skipped.
   --log=<path>          Task log output path.
   --nocolor             Disable colorized output.
+  --metrics=<path>      Write OpenMetrics to a file after each event.
+  --trace=<path>        Write a timeline of all events to a file.
+  --trace-format=<format>
+                        Trace file format, jsonl or chrome [default: jsonl].
+  --profile             Profile all python tasks, next to the log.
+  --profile-task=<ref>  Profile a single task.
+  --profile-memory      Also record the top memory allocations of tasks.
+  --scratch=<path>      Directory of the scratch mapset (eg. /dev/shm).
+  --stage=<path>        Run tasks using maps in a mapset in a local directory,
+                        for a GISDBASE on a network file system.
   --gisdbase=<path>     Initial GRASS GIS database directory.
   --location=<name>     Initial GRASS location.
   --mapset=<name>       Initial GRASS Mapset.
   --skip=<task>         Comma-separated list of tasks to skip.
   --only=<task>         Run a single task.
   --force               Force all tasks to run.
+  --invalidate=<resource>
+                        Run all tasks downstream of a resource or file.
+  --track-code          Run tasks whose python module, or GRASS GIS version,
+                        has changed since their last run.
   --vars=<vars>         Initial pipeline variables.
+  --workers=<n>         Number of instances to run at once.
 '''
 
 from __future__ import print_function
 
 import datetime
-import itertools
 import os
 import sys
-import traceback
-try:
-    from io import StringIO
-except ImportError:
-    from StringIO import StringIO
 
 import colorful
 import docopt
-import jinja2
 
-from .core import State
+from .core import _format_duration
+from .core import ExplainReporter
+from .core import MetricsReporter
+from .core import MultiReporter
 from .core import Platform
-from .core import TaskFatalEvent
-from .core import TaskCompleteEvent
-from .core import LocationEvent
-from .core import VerboseReporter
+from .core import Profiler
 from .core import SilentReporter
-from .core import analyse
-from .core import load
-from .core import execute
-from .session import session
+from .core import TracedPlatform
+from .core import TraceReporter
+from .core import VerboseReporter
+from .runner import Runner
+from .runner import read_instances
+from .runner import sweep
+
+
+def _write_log(path, results):
+    with open(path, 'w') as fp:
+        for result in results:
+            if len(results) > 1:
+                print('****MAPSET {}****'.format(result.mapset), file=fp)
+            print('****STDOUT****', file=fp)
+            fp.write(result.stdout)
+            print('****STDERR****', file=fp)
+            fp.write(result.stderr)
+
+
+def _sweep(args, variables, location):
+    '''Run a sweep, printing the outcome of each instance as it finishes.'''
+    # pylint: disable=no-member
+    instances = read_instances(args['<instances>'])
+    location['mapset'] = location['mapset'] or 'sweep_{index}'
+    workers = int(args['--workers']) if args['--workers'] else None
+    failures = []
+    results = []
+    finished = sweep(args['<pipeline>'], instances, vars=variables,
+                     workers=workers, force=args['--force'], **location)
+    for (count, (index, result)) in enumerate(finished, 1):
+        results.append(result)
+        outcome = colorful.green('ok')
+        if not result.ok:
+            failures.append(result)
+            outcome = colorful.red('failed')
+        print('[{}/{}] {} {} ({})'.format(
+            count, len(instances), result.mapset or index, outcome,
+            _format_duration(result.duration)))
+
+    print('{} instances, {} failed'.format(len(instances), len(failures)))
+    for result in failures:
+        error = result.errors[-1].strip().splitlines()[-1]
+        print('  {}: {}'.format(result.mapset, error))
+    if failures and not args['--log']:
+        uniq = datetime.datetime.now().strftime('%H_%M_%S_%f')
+        args['--log'] = 'stitches.grass-{}.log'.format(uniq)
+    if args['--log']:
+        _write_log(args['--log'], results)
+    sys.exit(1 if failures else 0)
 
 
 def main():
@@ -77,82 +149,79 @@ def main():
     reporter = SilentReporter()
     if args['--verbose']:
         reporter = VerboseReporter()
+    if args['--explain']:
+        reporter = MultiReporter(reporter, ExplainReporter())
     if args['--nocolor']:
         colorful.disable()  # pylint: disable=no-member
 
-    root = os.path.dirname(os.path.abspath(args['<pipeline>']))
-    jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(root))
-    jinja_env.filters['basename'] = os.path.basename
-    jinja_env.filters['dirname'] = os.path.dirname
-
-    # Load the stream of tasks
-    stream = load(jinja_env, {
-        'pipeline': os.path.basename(args['<pipeline>']),
-        'params': {
-            'vars': variables,
-            'gisdbase': args['--gisdbase'],
-            'location': args['--location'],
-            'mapset': args['--mapset'],
-        }
-    })
-
-    session_exists = bool(os.environ.get('GISRC'))
-
-    # Check the first item in the stream for a location event
-    event = next(stream, None)
-    if isinstance(event, LocationEvent):
-        gisdbase = event.gisdbase
-        location = event.location
-        mapset = event.mapset
-    else:
-        stream = itertools.chain(iter([event]), stream)
-
-    if session_exists:
-        from ._grass import gcore
-        env = gcore.gisenv()
-        gisdbase = gisdbase or env['GISDBASE']
-        location = location or env['LOCATION_NAME']
-        mapset = mapset or env['MAPSET']
-
-    # Load previous state
-    state = State.load(os.path.join(
-        gisdbase, location, mapset or 'PERMANENT', 'stitches.state.json'
-    ))
+    location = dict(gisdbase=args['--gisdbase'],
+                    location=args['--location'],
+                    mapset=args['--mapset'])
+
+    if args['affected']:
+        runner = Runner()
+        affected = runner.affected(args['<pipeline>'], args['<resource>'],
+                                   vars=variables, **location)
+        for (task, duration) in affected:
+            print('{}\t{}\t{}'.format(
+                task.ref, task.task or task.pipeline,
+                '?' if duration is None else _format_duration(duration)))
+        unknown = len([d for (_, d) in affected if d is None])
+        total = sum(d for (_, d) in affected if d is not None)
+        print('{} tasks affected, estimated {}{}'.format(
+            len(affected), _format_duration(total),
+            ' ({} unknown)'.format(unknown) if unknown else ''))
+        sys.exit(0)
+
+    if args['sweep']:
+        _sweep(args, variables, location)
+
+    if args['--metrics']:
+        reporter = MultiReporter(reporter, MetricsReporter(
+            args['--metrics'], pipeline=os.path.basename(args['<pipeline>'])))
+    trace = None
+    if args['--trace']:
+        trace = TraceReporter(args['--trace'], args['--trace-format'])
+        reporter = MultiReporter(reporter, trace)
 
     platform = Platform()
-
-    # Analyse the stream of events with the previous state
-    stream = analyse(stream, platform, state.history,
-                     force=args['--force'],
-                     skip=[a for a in (args['--skip'] or '').split(',') if a],
-                     only=args['--only'])
-
-    (code, stdout, stderr) = (0, StringIO(), StringIO())
-    try:
-        os.environ['GRASS_MESSAGE_FORMAT'] = 'plain'
-        with session(gisdbase, location, mapset=mapset, skip=session_exists):
-            for event in execute(stream, stdout, stderr):
-                if isinstance(event, TaskCompleteEvent):
-                    state.save()
-                reporter(event)
-            state.save()
-    except Exception:  # pylint: disable=broad-except
-        stack_trace = traceback.format_exc()
-        reporter(TaskFatalEvent(stack_trace))
-        if not args['--log']:
-            uniq = datetime.datetime.now().strftime('%H_%M_%S_%f')
-            args['--log'] = 'stitches.grass-{}.log'.format(uniq)
-        code = 1
+    if trace:
+        platform = TracedPlatform(platform, reporter)
+
+    profiler = None
+    if args['--profile'] or args['--profile-task']:
+        directory = 'stitches.profile'
+        if args['--log']:
+            directory = '{}.profile'.format(os.path.splitext(args['--log'])[0])
+        profiler = Profiler(directory,
+                            refs=args['--profile-task'] or None,
+                            memory=args['--profile-memory'])
+
+    runner = Runner(platform=platform)
+    result = runner.run(args['<pipeline>'], vars=variables,
+                        force=args['--force'],
+                        skip=[a for a in (args['--skip'] or '').split(',')
+                              if a],
+                        only=args['--only'],
+                        invalidate=args['--invalidate'],
+                        reporter=reporter,
+                        progress=args['--progress'],
+                        profiler=profiler,
+                        scratch=args['--scratch'],
+                        track_code=args['--track-code'],
+                        stage=args['--stage'],
+                        **location)
+
+    if trace:
+        trace.close()
+    if profiler:
+        profiler.summary()
+
+    if not result.ok and not args['--log']:
+        uniq = datetime.datetime.now().strftime('%H_%M_%S_%f')
+        args['--log'] = 'stitches.grass-{}.log'.format(uniq)
 
     if args['--log']:
-        outlog = stdout.getvalue()
-        errlog = stderr.getvalue()
-        with open(args['--log'], 'w') as fp:
-            print('****STDOUT****', file=fp)
-            fp.write(outlog)
-            print('****STDERR****', file=fp)
-            fp.write(errlog)
-        stdout.close()
-        stderr.close()
+        _write_log(args['--log'], [result])
 
-    sys.exit(code)
+    sys.exit(0 if result.ok else 1)
@@ -16,17 +16,35 @@
 from __future__ import print_function
 
 import collections
+import contextlib
+import cProfile
+import fnmatch
+import functools
 import hashlib
 import importlib
+import inspect
 import json
 import os
+import pstats
+import re
+import shutil
 import sys
+import tempfile
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import colorful
 import wurlitzer
 import toml
 
 
+# Monotonic clock for timing tasks, where available
+_clock = getattr(time, 'monotonic', time.time)
+
+
 class Error(Exception):
     def __init__(self, message):
         super(Error, self).__init__()
@@ -36,22 +54,63 @@ class Error(Exception):
         return self.message
 
 
-class LocationEvent(object):
+class Event(object):
+    '''Base of all events, recording the (monotonic) time of creation.'''
+    def __init__(self):
+        self.timestamp = _clock()
+
+
+class LocationEvent(Event):
     def __init__(self, gisdbase=None, location=None, mapset=None):
+        super(LocationEvent, self).__init__()
         self.gisdbase = gisdbase
         self.location = location
         self.mapset = mapset
 
 
-class TaskEvent(object):
+class PipelineEvent(LocationEvent):
+    '''Start of a pipeline, summarising the tasks it contains.'''
+    def __init__(self, gisdbase=None, location=None, mapset=None,
+                 pipeline=None, ref=None, inputs=None, outputs=None,
+                 always=None, hash_=None, execution=None):
+        super(PipelineEvent, self).__init__(gisdbase=gisdbase,
+                                            location=location,
+                                            mapset=mapset)
+        self.pipeline = pipeline
+        self.ref = ref
+        # Execution profile inherited by all tasks in the pipeline
+        self.execution = execution or {}
+        # Resources consumed, but not created, by tasks in the pipeline
+        self.inputs = inputs or []
+        # Resources left behind by tasks in the pipeline
+        self.outputs = outputs or []
+        self.always = always
+        # Aggregate of all task hashes, only known for sub-pipelines
+        self.hash = hash_
+        # A task for each callable run by a sub-pipeline, to fingerprint
+        self.tasks = []
+        # Seconds taken to expand the pipeline
+        self.loading = None
+
+
+class TaskEvent(Event):
     def __init__(self, task, pipeline=None, ref=None, params=None, inputs=None,
                  outputs=None, removes=None, message=None, always=None,
-                 status=None, hash_=None):
+                 status=None, hash_=None, duration=None, planning=None,
+                 execution=None, temporary=None, scratch=None):
+        super(TaskEvent, self).__init__()
         self.task = task
         self.params = params
+        self.execution = execution or {}
         self.inputs = inputs
         self.outputs = outputs
         self.removes = removes
+        # Outputs removed once no longer needed by other tasks
+        self.temporary = temporary or []
+        # Run with the scratch mapset as the current mapset
+        self.scratch = scratch
+        # Maps registered, or changed, in input datasets since the last run
+        self.changes = {}
         self.message = message
         self.always = always
         # Improved error reporting
@@ -60,29 +119,90 @@ class TaskEvent(object):
         # Calculated later
         self.status = status
         self.hash = hash_
+        # Seconds taken to execute the task
+        self.duration = duration
+        # Clock time, and seconds taken, to determine the status of the task
+        self.planned = None
+        self.planning = planning
+        # Why the status was chosen, and the tests made by the decision trees
+        self.reason = None
+        self.decisions = []
+
 
+class PlanEvent(Event):
+    def __init__(self, tasks):
+        super(PlanEvent, self).__init__()
+        self.tasks = tasks
 
-class TaskStartEvent(object):
-    def __init__(self, ref, description):
+
+class TaskStartEvent(Event):
+    def __init__(self, ref, description, task=None):
+        super(TaskStartEvent, self).__init__()
         self.ref = ref
         self.description = description
+        self.task = task
 
 
-class TaskCompleteEvent(object):
+class TaskCompleteEvent(Event):
     def __init__(self, task):
+        super(TaskCompleteEvent, self).__init__()
         self.task = task
 
 
-class TaskSkipEvent(object):
+class TaskSkipEvent(Event):
     def __init__(self, task):
+        super(TaskSkipEvent, self).__init__()
         self.task = task
 
 
-class TaskFatalEvent(object):
+class TaskFatalEvent(Event):
     def __init__(self, traceback):
+        super(TaskFatalEvent, self).__init__()
         self.traceback = traceback
 
 
+class StateSaveEvent(Event):
+    def __init__(self, duration):
+        super(StateSaveEvent, self).__init__()
+        self.duration = duration
+
+
+class CleanupEvent(Event):
+    def __init__(self, resources, duration):
+        super(CleanupEvent, self).__init__()
+        self.resources = resources
+        self.duration = duration
+
+
+class PlatformQueryEvent(Event):
+    def __init__(self, query, args, started, duration):
+        super(PlatformQueryEvent, self).__init__()
+        self.query = query
+        self.args = args
+        self.started = started
+        self.duration = duration
+
+
+def _atomic_write(path, data):
+    '''Write a file so that readers never see partially written contents.'''
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False,
+                                     prefix='.stitches_') as fp:
+        fp.write(data)
+    os.chmod(fp.name, 0o644)
+    getattr(os, 'replace', os.rename)(fp.name, path)
+
+
+class MultiReporter(object):
+
+    def __init__(self, *reporters):
+        self.reporters = reporters
+
+    def __call__(self, event):
+        for reporter in self.reporters:
+            reporter(event)
+
+
 class SilentReporter(object):
 
     def __init__(self):
@@ -125,20 +245,449 @@ class VerboseReporter(object):
                 print(line, file=sys.stderr)
 
 
+class ExplainReporter(object):
+    '''Reports why each task is run, or skipped.'''
+
+    COLORS = {'run': 'green', 'skip': 'orange', 'fail': 'red'}
+
+    def __call__(self, event):
+        if not isinstance(event, TaskStartEvent) or event.task is None:
+            return
+        task = event.task
+        print(colorful.format('{c.bold}[{}]{c.reset} {c.%s}{}{c.reset}: {}'
+                              % self.COLORS.get(task.status, 'reset'),
+                              event.ref, task.status, task.reason))
+
+
+def _format_duration(seconds):
+    seconds = int(round(seconds))
+    (minutes, seconds) = divmod(seconds, 60)
+    (hours, minutes) = divmod(minutes, 60)
+    if hours:
+        return '{}h{:02d}m'.format(hours, minutes)
+    if minutes:
+        return '{}m{:02d}s'.format(minutes, seconds)
+    return '{}s'.format(seconds)
+
+
+class ProgressReporter(object):
+    '''Reports progress estimated from the durations of previous runs.
+
+    Tasks seen in a previous run are expected to be skipped. Tasks without a
+    recorded duration are estimated from the average duration of tasks with
+    the same name, from previous runs and the current one. Failures are left
+    to the reporter it is used alongside.
+    '''
+    SLOW_FACTOR = 1.5
+    SLOW_MINIMUM = 1.0
+
+    def __init__(self, history, force=False):
+        self.history = history
+        self.force = force
+        self.total = 0
+        self.finished = 0
+        # Seconds spent on finished tasks
+        self.elapsed = 0.0
+        # Predicted seconds for pending tasks with a known duration
+        self.known = 0.0
+        # Pending tasks without a known duration, by task name
+        self.unknown = collections.Counter()
+        self.predicted = {}
+        self.durations = collections.defaultdict(lambda: [0.0, 0])
+        self.expected = None
+        for entry in history.values():
+            if 'duration' in entry and 'task' in entry:
+                self._sample(entry['task'], entry['duration'])
+
+    def _sample(self, name, duration):
+        self.durations[name][0] += duration
+        self.durations[name][1] += 1
+        self.durations[None][0] += duration
+        self.durations[None][1] += 1
+
+    def _mean(self, name):
+        for key in (name, None):
+            (total, count) = self.durations.get(key, (0.0, 0))
+            if count:
+                return total / count
+        return None
+
+    def _predict(self, task):
+        entry = self.history.get(task.hash)
+        if entry is None:
+            return None
+        if not (self.force or task.always):
+            return 0.0
+        return entry.get('duration')
+
+    def _remaining(self):
+        remaining = self.known + (self.expected or 0.0)
+        for (name, count) in self.unknown.items():
+            if not count:
+                continue
+            mean = self._mean(name)
+            if mean is None:
+                return None
+            remaining += count * mean
+        return remaining
+
+    def _progress(self):
+        remaining = self._remaining()
+        if remaining is None:
+            percent = 100.0 * self.finished / max(self.total, 1)
+            return '{:.0f}%'.format(percent)
+        if self.elapsed + remaining > 0:
+            percent = 100.0 * self.elapsed / (self.elapsed + remaining)
+        else:
+            percent = 100.0 * self.finished / max(self.total, 1)
+        return '{:.0f}%, {} remaining'.format(
+            percent, _format_duration(remaining))
+
+    def _start(self, task):
+        predicted = self.predicted.pop(task.ref, None)
+        if predicted is None:
+            if self.unknown[task.task] > 0:
+                self.unknown[task.task] -= 1
+        else:
+            self.known -= predicted
+        self.expected = 0.0
+        if task.status == TaskStatus.RUN:
+            entry = self.history.get(task.hash, {})
+            self.expected = entry.get('duration', self._mean(task.task))
+
+    def __call__(self, event):
+        # pylint: disable=no-member
+        if isinstance(event, PlanEvent):
+            for task in event.tasks:
+                predicted = self._predict(task)
+                if predicted is None:
+                    self.unknown[task.task] += 1
+                else:
+                    self.known += predicted
+                    self.predicted[task.ref] = predicted
+            self.total = len(event.tasks)
+        elif isinstance(event, TaskStartEvent):
+            if event.task is not None:
+                self._start(event.task)
+            print(colorful.format('{c.bold}[{}]: {}{c.reset} ({})',
+                                  event.ref,
+                                  event.description,
+                                  self._progress()))
+        elif isinstance(event, TaskSkipEvent):
+            self.finished += 1
+            self.expected = None
+            print(colorful.format('  {c.orange}Skipped{c.reset}'))
+        elif isinstance(event, TaskCompleteEvent):
+            task = event.task
+            duration = task.duration or 0.0
+            self.finished += 1
+            self.elapsed += duration
+            self._sample(task.task, duration)
+            print(colorful.format('  {c.green}Completed{c.reset} in {}',
+                                  _format_duration(duration)))
+            expected = self.expected
+            self.expected = None
+            if (expected and duration > expected * self.SLOW_FACTOR and
+                    duration - expected > self.SLOW_MINIMUM):
+                print(colorful.format(
+                    '  {c.orange}Slower than previous runs ({} vs {}){c.reset}',
+                    _format_duration(duration),
+                    _format_duration(expected)))
+
+
+def _metric_labels(**labels):
+    escaped = []
+    for (name, value) in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n')
+        escaped.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(escaped) + '}'
+
+
+class MetricsReporter(object):
+    '''Writes metrics about the run to a file in the OpenMetrics format.
+
+    The file is rewritten after each event, for collection by a textfile
+    collector such as the one provided by the Prometheus node exporter.
+    '''
+    BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0, 1800.0,
+               3600.0, float('inf'))
+
+    def __init__(self, path, pipeline=''):
+        self.path = path
+        self.pipeline = pipeline
+        self.current_task = None
+        self.counts = collections.OrderedDict([
+            ('completed', 0),
+            ('skipped', 0),
+            ('failed', 0),
+        ])
+        self.histograms = collections.OrderedDict()
+        self.planning = 0.0
+        self.saving = 0.0
+        self.saves = 0
+
+    def _observe(self, name, value):
+        if name not in self.histograms:
+            self.histograms[name] = [[0] * len(self.BUCKETS), 0.0, 0]
+        histogram = self.histograms[name]
+        for (i, bound) in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def _render(self):
+        pipeline = self.pipeline
+        lines = [
+            '# HELP stitches_tasks Tasks processed by status.',
+            '# TYPE stitches_tasks counter',
+        ]
+        for (status, count) in self.counts.items():
+            lines.append('stitches_tasks_total{} {}'.format(
+                _metric_labels(pipeline=pipeline, status=status), count))
+
+        finished = self.counts['completed'] + self.counts['skipped']
+        ratio = float(self.counts['skipped']) / finished if finished else 0.0
+        lines += [
+            '# HELP stitches_cache_hit_ratio Ratio of tasks skipped.',
+            '# TYPE stitches_cache_hit_ratio gauge',
+            'stitches_cache_hit_ratio{} {}'.format(
+                _metric_labels(pipeline=pipeline), ratio),
+            '# HELP stitches_task_duration_seconds Duration of tasks run.',
+            '# TYPE stitches_task_duration_seconds histogram',
+        ]
+        for (task, (buckets, total, count)) in self.histograms.items():
+            for (bound, value) in zip(self.BUCKETS, buckets):
+                bound = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('stitches_task_duration_seconds_bucket{} {}'
+                             .format(_metric_labels(pipeline=pipeline,
+                                                    task=task,
+                                                    le=bound), value))
+            labels = _metric_labels(pipeline=pipeline, task=task)
+            lines.append('stitches_task_duration_seconds_sum{} {}'.format(
+                labels, total))
+            lines.append('stitches_task_duration_seconds_count{} {}'.format(
+                labels, count))
+
+        labels = _metric_labels(pipeline=pipeline)
+        lines += [
+            '# HELP stitches_planning_seconds Time spent analysing tasks.',
+            '# TYPE stitches_planning_seconds counter',
+            'stitches_planning_seconds_total{} {}'.format(
+                labels, self.planning),
+            '# HELP stitches_state_save_seconds Time spent saving state.',
+            '# TYPE stitches_state_save_seconds counter',
+            'stitches_state_save_seconds_total{} {}'.format(
+                labels, self.saving),
+            '# HELP stitches_state_saves Number of times state was saved.',
+            '# TYPE stitches_state_saves counter',
+            'stitches_state_saves_total{} {}'.format(labels, self.saves),
+            '# EOF',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def __call__(self, event):
+        if isinstance(event, TaskStartEvent):
+            self.current_task = event
+            return
+        elif isinstance(event, TaskSkipEvent):
+            self.counts['skipped'] += 1
+            self.planning += event.task.planning or 0.0
+            self.current_task = None
+        elif isinstance(event, TaskCompleteEvent):
+            self.counts['completed'] += 1
+            self.planning += event.task.planning or 0.0
+            self._observe(event.task.task, event.task.duration or 0.0)
+            self.current_task = None
+        elif isinstance(event, TaskFatalEvent):
+            if self.current_task is not None:
+                self.counts['failed'] += 1
+            self.current_task = None
+        elif isinstance(event, StateSaveEvent):
+            self.saving += event.duration
+            self.saves += 1
+        else:
+            return
+        _atomic_write(self.path, self._render())
+
+
+_TRACE_THREADS = collections.OrderedDict([
+    ('load', 1),
+    ('analyse', 2),
+    ('execute', 3),
+    ('state', 4),
+])
+
+
+def _trace_record(event, thread, name, timestamp, duration=None, **args):
+    record = {
+        'event': event,
+        'thread': thread,
+        'name': name,
+        'ts': timestamp,
+        'args': args,
+    }
+    if duration is not None:
+        record['dur'] = duration
+    return record
+
+
+def chrome_trace(records):
+    '''Convert trace records to the Chrome trace event format.'''
+    events = [{
+        'ph': 'M',
+        'name': 'thread_name',
+        'pid': 1,
+        'tid': tid,
+        'args': {'name': name},
+    } for (name, tid) in _TRACE_THREADS.items()]
+    origin = min([record['ts'] for record in records] or [0])
+    for record in records:
+        event = {
+            'name': record['name'],
+            'cat': record['event'],
+            'pid': 1,
+            'tid': _TRACE_THREADS[record['thread']],
+            'ts': (record['ts'] - origin) * 1e6,
+            'args': record['args'],
+        }
+        if 'dur' in record:
+            event['ph'] = 'X'
+            event['dur'] = record['dur'] * 1e6
+        else:
+            event['ph'] = 'i'
+            event['s'] = 't'
+        events.append(event)
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+class TraceReporter(object):
+    '''Writes a timeline of all events to a file.
+
+    Records are written as they happen, one JSON object per line, or in the
+    Chrome trace event format when the reporter is closed.
+    '''
+    JSONL = 'jsonl'
+    CHROME = 'chrome'
+
+    def __init__(self, path, format_=JSONL):
+        if format_ not in (TraceReporter.JSONL, TraceReporter.CHROME):
+            raise Error('Unknown trace format "{}"'.format(format_))
+        self.path = path
+        self.format = format_
+        self.records = []
+        self.current_task = None
+        self.fp = open(path, 'w') if format_ == TraceReporter.JSONL else None
+
+    def _task_records(self, event, name, **args):
+        start = self.current_task
+        self.current_task = None
+        if start is None:
+            return [_trace_record(name, 'execute', name, event.timestamp,
+                                  **args)]
+        args['message'] = start.description
+        return [_trace_record(name, 'execute', start.ref, start.timestamp,
+                              event.timestamp - start.timestamp, **args)]
+
+    def _records(self, event):
+        if isinstance(event, PipelineEvent):
+            return [_trace_record('pipeline', 'load', event.pipeline,
+                                  event.timestamp, event.loading,
+                                  ref=event.ref, hash=event.hash,
+                                  gisdbase=event.gisdbase,
+                                  location=event.location,
+                                  mapset=event.mapset)]
+        elif isinstance(event, LocationEvent):
+            return [_trace_record('location', 'load', 'location',
+                                  event.timestamp, gisdbase=event.gisdbase,
+                                  location=event.location,
+                                  mapset=event.mapset)]
+        elif isinstance(event, PlanEvent):
+            return [_trace_record('plan', 'load', 'plan', event.timestamp,
+                                  tasks=len(event.tasks))]
+        elif isinstance(event, TaskStartEvent):
+            self.current_task = event
+            task = event.task
+            if task is None:
+                return []
+            records = [_trace_record('task_load', 'load', task.ref,
+                                     task.timestamp, task=task.task,
+                                     hash=task.hash)]
+            if task.planned is not None:
+                records.append(_trace_record('task_plan', 'analyse', task.ref,
+                                             task.planned, task.planning,
+                                             status=task.status,
+                                             reason=task.reason))
+            return records
+        elif isinstance(event, TaskSkipEvent):
+            return self._task_records(event, 'task_skip',
+                                      task=event.task.task)
+        elif isinstance(event, TaskCompleteEvent):
+            return self._task_records(event, 'task_complete',
+                                      task=event.task.task)
+        elif isinstance(event, TaskFatalEvent):
+            return self._task_records(event, 'task_fatal',
+                                      traceback=event.traceback)
+        elif isinstance(event, StateSaveEvent):
+            return [_trace_record('state_save', 'state', 'save',
+                                  event.timestamp - event.duration,
+                                  event.duration)]
+        elif isinstance(event, CleanupEvent):
+            return [_trace_record('cleanup', 'execute', 'cleanup',
+                                  event.timestamp - event.duration,
+                                  event.duration,
+                                  resources=[resource.ref() for resource
+                                             in event.resources])]
+        elif isinstance(event, PlatformQueryEvent):
+            return [_trace_record('platform_query', 'analyse', event.query,
+                                  event.started, event.duration,
+                                  args=event.args)]
+        return []
+
+    def __call__(self, event):
+        for record in self._records(event):
+            if self.fp is not None:
+                self.fp.write(json.dumps(record, sort_keys=True) + '\n')
+                self.fp.flush()
+            else:
+                self.records.append(record)
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        elif self.format == TraceReporter.CHROME:
+            with open(self.path, 'w') as fp:
+                json.dump(chrome_trace(self.records), fp)
+
+
+_GLOB = re.compile(r'[*?[]')
+
+
 class Resource(object):
     FILE = 'file'
+    DIR = 'dir'
     VECTOR = 'vector'
     RASTER = 'raster'
+    STRDS = 'strds'
+    STVDS = 'stvds'
+    DATASETS = (STRDS, STVDS)
 
     def __init__(self, ref):
         self._ref = ref
         (type_, rest) = ref.split('/', 1)
 
-        if type_ == Resource.FILE:
+        if type_ in (Resource.FILE, Resource.DIR):
+            # Globs match the names of files in a single directory
             self.type = type_
             self.path = rest
+            self.pattern = None
+            if type_ == Resource.FILE and _GLOB.search(rest):
+                (self.path, self.pattern) = os.path.split(rest)
+                self.path = self.path or os.curdir
 
-        elif type_ in (Resource.VECTOR, Resource.RASTER):
+        elif type_ in (Resource.VECTOR, Resource.RASTER) + Resource.DATASETS:
             components = rest.split('@', 1)
             self.type = type_
             self.name = components[0]
@@ -162,6 +711,26 @@ class Resource(object):
     def ref(self):
         return self._ref
 
+    def collection(self):
+        '''Returns true if the resource is a directory or glob of files.'''
+        if self.type == Resource.FILE:
+            return self.pattern is not None
+        return self.type == Resource.DIR
+
+
+_CALLABLE_REF = re.compile(r'^[\w.]+:[\w.]+$')
+
+
+def _is_callable_ref(name):
+    '''Returns true if the name refers to a python callable.'''
+    return bool(_CALLABLE_REF.match(name))
+
+
+def _import_callable(name):
+    '''Import a callable from a reference like ``package.module:function``.'''
+    (module, attr) = name.split(':')
+    return getattr(importlib.import_module(module), attr)
+
 
 def _object_checksum(obj):
     hasher = hashlib.md5()
@@ -169,7 +738,116 @@ def _object_checksum(obj):
     return hasher.hexdigest()
 
 
+# Elements of a mapset with an entry for each map of a type
+_MAP_ELEMENTS = {Resource.RASTER: 'cellhd', Resource.VECTOR: 'vector'}
+
+
+def _session_place():
+    '''Return the database, location and mapset of the current session.
+
+    Read from the ``GISRC`` file, rather than by running a GRASS GIS module.
+    Returns None without a session.
+    '''
+    env = {}
+    try:
+        with open(os.environ['GISRC']) as fp:
+            for line in fp:
+                (key, _, value) = line.partition(':')
+                env[key.strip()] = value.strip()
+    except (KeyError, IOError, OSError):
+        return None
+    return (env.get('GISDBASE'), env.get('LOCATION_NAME'), env.get('MAPSET'))
+
+
+def _search_path(lpath, mapset):
+    '''Return the mapsets searched for maps, from a mapset.'''
+    path = os.path.join(lpath, mapset, 'SEARCH_PATH')
+    if not os.path.exists(path):
+        return [mapset] if mapset == 'PERMANENT' else [mapset, 'PERMANENT']
+    with open(path) as fp:
+        return [line.strip() for line in fp if line.strip()]
+
+
+def _mtime(path):
+    '''Return the modification time, and size, of a path if it exists.'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def _map_stamp(type_):
+    '''Return the modification times of the maps of a type in the session.
+
+    Returned with a key for the maps, of the mapset and type.
+    '''
+    place = _session_place()
+    if place is None or type_ not in _MAP_ELEMENTS:
+        return (None, None)
+    (gisdbase, location, mapset) = place
+    lpath = os.path.join(gisdbase, location)
+    mapsets = _search_path(lpath, mapset)
+    stamp = [_mtime(os.path.join(lpath, name, _MAP_ELEMENTS[type_]))
+             for name in mapsets]
+    return ((gisdbase, location, mapset, type_), [mapsets, stamp])
+
+
+def _region_stamp():
+    '''Return the modification time of the region of the session.
+
+    Returned with a key for the region, of the mapset.
+    '''
+    place = _session_place()
+    if place is None:
+        return (None, None)
+    stamp = [_mtime(os.path.join(place[0], place[1], place[2], 'WIND')),
+             os.environ.get('WIND_OVERRIDE'), os.environ.get('GRASS_REGION')]
+    return (place, stamp)
+
+
 class Platform(object):
+    '''Queries made against the file system and the current GRASS session.
+
+    The maps of each type, and the region, are listed once for each mapset
+    and kept until the files of the mapsets they were read from are modified,
+    so they are reused across sessions and runs. After a task is run,
+    ``update`` adds the maps it created without listing them again. Space time
+    datasets are kept until ``update`` or ``invalidate`` is called.
+    '''
+
+    def __init__(self):
+        self._maps = {}
+        self._datasets = {}
+        self._region = {}
+
+    def invalidate(self):
+        '''Forget all cached queries.'''
+        self._maps = {}
+        self._datasets = {}
+        self._region = {}
+
+    def update(self, outputs=(), removes=()):
+        '''Forget what may have changed, after a task has been run.
+
+        Maps created by the task, in the current mapset, are added to those
+        already listed. The region of the current mapset is read again, and
+        maps are listed again after any are removed.
+        '''
+        self._datasets = {}
+        self._region.pop(_session_place(), None)
+        for type_ in _MAP_ELEMENTS:
+            (key, stamp) = _map_stamp(type_)
+            if key not in self._maps:
+                continue
+            if any(r.type == type_ for r in removes) or any(
+                    r.type == type_ and r.mapset is not None
+                    for r in outputs):
+                del self._maps[key]
+                continue
+            maps = self._maps[key][1]
+            maps.update(r.name for r in outputs if r.type == type_)
+            self._maps[key] = (stamp, maps)
 
     def file_mtime(self, path):
         return os.stat(path).st_mtime
@@ -177,48 +855,381 @@ class Platform(object):
     def file_exists(self, path):
         return os.path.exists(path)
 
-    def map_exists(self, type_, name):
+    def file_manifest(self, path, pattern=None):
+        '''Return a checksum of the files in a directory, matching a pattern.
+
+        The checksum covers the name, size and modification time of each file,
+        so that a whole directory is checked with a single pass over it.
+        '''
+        return _object_checksum(_manifest(path, pattern))
+
+    def file_digest(self, path, pattern=None):
+        '''Return a digest of the contents of a file, glob or directory.'''
+        if not os.path.exists(path):
+            return None
+        if not os.path.isdir(path):
+            return _digest_files([path])
+        names = [name for (name, _, _) in _manifest(path, pattern)]
+        return _digest_files([os.path.join(path, name) for name in names],
+                             names=names)
+
+    def dataset_maps(self, type_, name):
+        '''Return a fingerprint of each map registered in a space time dataset.
+
+        Maps are keyed by their id, and fingerprinted by their time stamps and
+        the modification time of their files. Returns None if the dataset is
+        missing.
+        '''
+        if (type_, name) not in self._datasets:
+            from ._grass import gcore
+            module = 't.rast.list' if type_ == Resource.STRDS else 't.vect.list'
+            try:
+                res = gcore.read_command(module, flags='u', input=name,
+                                         columns='id,start_time,end_time',
+                                         separator='pipe').splitlines()
+            except gcore.CalledModuleError:
+                res = None
+            maps = None
+            if res is not None:
+                env = gcore.gisenv()
+                lpath = os.path.join(env['GISDBASE'], env['LOCATION_NAME'])
+                maps = collections.OrderedDict()
+                for line in res:
+                    (id_, start, end) = line.decode('utf-8').split('|')
+                    mtime = _registered_mtime(lpath, type_, id_)
+                    maps[id_] = '{}|{}|{}'.format(start, end, mtime)
+            self._datasets[(type_, name)] = maps
+        return self._datasets[(type_, name)]
+
+    def map_digest(self, type_, name):
+        '''Return a digest of the data of a map, or None if it is missing.'''
         from ._grass import gcore
-        res = gcore.read_command(
-            'g.list', type=type_, pattern=name).splitlines()
-        if res and res[0].decode('utf-8') == name:
-            return True
-        return False
+        if type_ in Resource.DATASETS:
+            maps = self.dataset_maps(type_, name)
+            return None if maps is None else _object_checksum(maps)
+        element = 'cellhd' if type_ == Resource.RASTER else 'vector'
+        found = gcore.find_file(name, element=element)
+        if not found['file']:
+            return None
+        if type_ == Resource.RASTER:
+            mapset = os.path.dirname(os.path.dirname(found['file']))
+            paths = [os.path.join(mapset, directory, name)
+                     for directory in ('cellhd', 'cell', 'fcell')]
+            misc = os.path.join(mapset, 'cell_misc', name)
+            if os.path.isdir(misc):
+                paths.extend(os.path.join(misc, entry)
+                             for entry in sorted(os.listdir(misc)))
+            return _digest_files([p for p in paths if os.path.isfile(p)],
+                                 extra=_linked_source(
+                                     os.path.join(misc, 'gdal'), 'file'))
+        attributes = []
+        for layer in sorted(gcore.vector_db(found['fullname'])):
+            attributes.append(gcore.read_command(
+                'v.db.select', map=found['fullname'], layer=layer))
+        attributes.extend(_linked_source(
+            os.path.join(found['file'], 'frmt'), 'dsn'))
+        paths = [os.path.join(found['file'], entry)
+                 for entry in ('coor', 'cidx')]
+        return _digest_files([p for p in paths if os.path.isfile(p)],
+                             extra=attributes)
+
+    def map_exists(self, type_, name):
+        if type_ in Resource.DATASETS:
+            return self.dataset_maps(type_, name) is not None
+        (key, stamp) = _map_stamp(type_)
+        (seen, maps) = self._maps.get(key, (None, None))
+        if maps is None or seen != stamp or stamp is None:
+            from ._grass import gcore
+            res = gcore.read_command('g.list', type=type_).splitlines()
+            maps = set(line.decode('utf-8') for line in res)
+            self._maps[key] = (stamp, maps)
+        return name in maps
 
     def region_hash(self):
-        from ._grass import gcore
-        return _object_checksum(gcore.region())
+        (key, stamp) = _region_stamp()
+        (seen, region) = self._region.get(key, (None, None))
+        if region is None or seen != stamp or stamp is None:
+            from ._grass import gcore
+            region = _object_checksum(gcore.region())
+            self._region[key] = (stamp, region)
+        return region
+
+    def remove(self, resources, mapset=None):
+        '''Remove resources, with a single call to remove maps of each type.
+
+        Maps are removed from ``mapset``, eg. the scratch mapset, when given,
+        rather than the current mapset.
+        '''
+        names = collections.OrderedDict()
+        for resource in resources:
+            if resource.type == Resource.DIR:
+                shutil.rmtree(resource.path, ignore_errors=True)
+            elif resource.collection():
+                for (name, _, _) in _manifest(resource.path, resource.pattern):
+                    os.remove(os.path.join(resource.path, name))
+            elif resource.type == Resource.FILE:
+                if os.path.exists(resource.path):
+                    os.remove(resource.path)
+            else:
+                names.setdefault(resource.type, []).append(resource.name)
+        if not names:
+            return
+        if mapset is not None:
+            from .session import use_mapset
+            with use_mapset(mapset):
+                _remove_maps(names)
+        else:
+            _remove_maps(names)
+        self.update(removes=resources)
+
+
+def _remove_maps(names):
+    '''Remove maps, of each type, from the current mapset.'''
+    from ._grass import gcore
+    for (type_, maps) in names.items():
+        if type_ in Resource.DATASETS:
+            # Registered maps are kept
+            gcore.run_command('t.remove', flags='f', quiet=True,
+                              type=type_, inputs=','.join(maps))
+            continue
+        gcore.run_command('g.remove', flags='f', quiet=True,
+                          type=type_, name=','.join(maps))
+
+
+def _linked_source(path, key):
+    '''Return the size and mtime of the data read by a linked map.
+
+    Maps linked with ``r.external`` or ``v.external`` name their source in a
+    file of ``key: value`` lines, where the source is outside the mapset.
+    '''
+    if not os.path.isfile(path):
+        return []
+    source = None
+    with open(path) as fp:
+        for line in fp:
+            (name, _, value) = line.partition(':')
+            if name.strip() == key:
+                source = value.strip()
+                break
+    if source is None or not os.path.exists(source):
+        return []
+    if os.path.isdir(source):
+        return [json.dumps(_manifest(source))]
+    stat = os.stat(source)
+    return ['{}|{}|{}'.format(source, stat.st_size, stat.st_mtime)]
+
+
+def _registered_mtime(lpath, type_, id_):
+    '''Return the modification time of a map registered in a dataset.'''
+    (name, mapset) = id_.split('@', 1)
+    if type_ == Resource.STRDS:
+        paths = [os.path.join(lpath, mapset, element, name)
+                 for element in ('cellhd', 'cell', 'fcell')]
+    else:
+        # Maps of a vector dataset may be registered by layer
+        paths = [os.path.join(lpath, mapset, 'vector', name.split(':')[0],
+                              'coor')]
+    mtimes = [os.stat(p).st_mtime for p in paths if os.path.exists(p)]
+    return max(mtimes) if mtimes else None
+
+
+def _dataset_changes(previous, current):
+    '''Return the ids of maps registered, or changed, since a previous run.'''
+    previous = previous or {}
+    return [id_ for (id_, fingerprint) in current.items()
+            if previous.get(id_) != fingerprint]
+
+
+def _scandir(path):
+    '''Yield the name and stat result of each entry in a directory.'''
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            yield (entry.name, entry.stat())
+    else:
+        for name in os.listdir(path):
+            yield (name, os.stat(os.path.join(path, name)))
+
+
+def _digest_files(paths, names=None, extra=None):
+    '''Return an md5 digest of the contents of files, read in chunks.'''
+    hasher = hashlib.md5()
+    for (index, path) in enumerate(paths):
+        hasher.update((names[index] if names else '').encode('utf-8'))
+        with open(path, 'rb') as fp:
+            for chunk in iter(functools.partial(fp.read, 1 << 20), b''):
+                hasher.update(chunk)
+    for data in extra or []:
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        hasher.update(data)
+    return hasher.hexdigest()
+
+
+def _output_digest(platform, resource):
+    '''Return a digest of the contents of an output, or None if missing.'''
+    if resource.type in (Resource.FILE, Resource.DIR):
+        return platform.file_digest(resource.path, resource.pattern)
+    return platform.map_digest(resource.type, resource.name)
+
+
+def _record_outputs(planner, task, task_history):
+    '''Record digests of the outputs of a task that was run.
+
+    Tasks using an output compare its digest with the one they last ran with,
+    so that they are not run when it is identical. Outputs nothing else uses
+    are not digested.
+    '''
+    task_history['outputs'] = {}
+    for resource in task.outputs:
+        ref = resource.ref()
+        planner.digests.pop(ref, None)
+        if planner.index is not None and not planner.index.consumers.get(ref):
+            continue
+        digest = _output_digest(planner.platform, resource)
+        if digest is None:
+            continue
+        task_history['outputs'][ref] = digest
+        planner.digests[ref] = digest
+
+
+def _record_used(planner, task, task_history):
+    '''Record the digests of the maps a task was run with.'''
+    task_history['used'] = {}
+    for resource in task.inputs:
+        digest = planner.digests.get(resource.ref())
+        if digest is not None:
+            task_history['used'][resource.ref()] = digest
+
+
+def _manifest(path, pattern=None):
+    '''Return the name, size and mtime of the files in a directory.'''
+    manifest = []
+    for (name, stat) in _scandir(path):
+        if pattern is None or fnmatch.fnmatch(name, pattern):
+            manifest.append((name, stat.st_size, stat.st_mtime))
+    return sorted(manifest)
+
+
+def _file_fingerprint(platform, resource):
+    '''Return the value recorded in the history for a file input.'''
+    if resource.collection():
+        return platform.file_manifest(resource.path, resource.pattern)
+    return platform.file_mtime(resource.path)
+
+
+def _traced_arg(value):
+    '''Return a value that may be written to a trace file.'''
+    if isinstance(value, Resource):
+        return value.ref()
+    if isinstance(value, (list, tuple)):
+        return [_traced_arg(item) for item in value]
+    if value is None or isinstance(value, (str, type(u''), bool, int, float)):
+        return value
+    return str(value)
+
+
+class TracedPlatform(object):
+    '''Reports the time taken by each query made against a platform.'''
+
+    def __init__(self, platform, reporter):
+        self.platform = platform
+        self.reporter = reporter
+
+    def invalidate(self):
+        self.platform.invalidate()
+
+    def update(self, outputs=(), removes=()):
+        self.platform.update(outputs, removes)
+
+    def __getattr__(self, name):
+        attr = getattr(self.platform, name)
+        if not callable(attr):
+            return attr
+
+        def traced(*args):
+            started = _clock()
+            try:
+                return attr(*args)
+            finally:
+                self.reporter(PlatformQueryEvent(
+                    name, _traced_arg(args), started, _clock() - started))
+        return traced
+
+
+@contextlib.contextmanager
+def _file_lock(path, blocking=True, message=None):
+    '''Hold an advisory lock on a file, where supported by the platform.'''
+    with open(path, 'a') as fp:
+        if fcntl is not None:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(fp, flags)
+            except (IOError, OSError):
+                raise Error(message or 'File "{}" is locked'.format(path))
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def _read_state(path):
+    try:
+        with open(path, 'r') as fp:
+            return json.load(fp)
+    except IOError:
+        return {}
 
 
 class State(object):
     '''Retained state between each run.
 
+    The history of each pipeline is kept under its own namespace, so that
+    different pipelines may be run at the same time against the same mapset.
+
     TODO: Try and store this is a sqlite table in the grass region.
     '''
 
-    def __init__(self, path, history=None):
+    def __init__(self, path, history=None, namespace=''):
         self.path = path
+        self.namespace = namespace
         self.history = collections.defaultdict(dict, **(history or {}))
 
     @classmethod
-    def load(cls, path):
-        try:
-            with open(path, 'r') as fp:
-                data = json.load(fp)
-        except IOError:
-            data = {}
-        return cls(path, **data)
+    def load(cls, path, namespace=''):
+        data = _read_state(path)
+        pipelines = data.get('pipelines', {})
+        if namespace in pipelines:
+            history = pipelines[namespace]['history']
+        else:
+            # State written before namespaces were introduced
+            history = data.get('history')
+        return cls(path, history=history, namespace=namespace)
+
+    @contextlib.contextmanager
+    def lock(self):
+        '''Prevent the same pipeline from being run concurrently.'''
+        key = hashlib.md5(self.namespace.encode('utf-8')).hexdigest()
+        path = '{}.{}.lock'.format(os.path.splitext(self.path)[0], key[:12])
+        message = 'Pipeline "{}" is already running'.format(self.namespace)
+        with _file_lock(path, blocking=False, message=message):
+            yield
 
     def save(self):
-        serialized = json.dumps({
-            'history': self.history,
-        }, indent=2)
-        with open(self.path, 'w') as fp:
-            fp.write(serialized)
+        '''Replace the history of this pipeline, keeping that of others.'''
+        with _file_lock('{}.lock'.format(self.path)):
+            pipelines = _read_state(self.path).get('pipelines', {})
+            pipelines[self.namespace] = {'history': self.history}
+            _atomic_write(self.path, json.dumps({
+                'pipelines': pipelines,
+            }, indent=2, sort_keys=True))
 
 
 class OutputStatus(object):
     EXISTS = 'exists'
+    CLEANED = 'cleaned'
 
 
 class InputStatus(object):
@@ -236,33 +1247,58 @@ class TaskStatus(object):
 
 class StatusContext(object):
     '''Context that lives during input resolution.'''
-    def __init__(self, platform, history, skip, force, only):
+    def __init__(self, platform, history, skip, force, only, index=None,
+                 invalidated=None, fingerprint=None):
         self.platform = platform
         self.history = history
+        self.index = index
+        # Returns a fingerprint of the code run by a task, if tracked
+        self.fingerprint = fingerprint
+        # Tasks to run, regardless of their history
+        self.invalidated = set(invalidated or [])
         self.created = {}
         self.statuses = {}
+        # Temporary resources removed after a previous run, and not recreated
+        self.cleaned = set()
+        # Digests of the outputs of the tasks seen so far
+        self.digests = {}
         self.force = force
         self.skip = skip
         self.only = only
         self.task = None
+        # Tests made by decision trees for the current task, as tuples of the
+        # test name, the reference of its subject and the outcome
+        self.path = []
+        self.reason = None
+
+
+def _subject_ref(subject):
+    ref = getattr(subject, 'ref', None)
+    return ref() if callable(ref) else ref
 
 
 def decision(test=None, true=None, false=None, result=None):
-    '''A function to build up a decision tree.'''
+    '''A function to build up a decision tree.
+
+    The path taken through the tree is recorded by the ``StatusContext``.
+    '''
     if test:
         assert true and false
-    def wrapper(*args, **kwargs):
+    def wrapper(planner, subject):
         if test:
-            if test(*args, **kwargs):
-                return true(*args, **kwargs)
-            return false(*args, **kwargs)
+            outcome = bool(test(planner, subject))
+            planner.path.append((test.__name__, _subject_ref(subject),
+                                 outcome))
+            if outcome:
+                return true(planner, subject)
+            return false(planner, subject)
         return result
     return wrapper
 
 
 def _is_grass_map(_, resource):
     '''Returns true if the resource is a grass map.'''
-    return resource.type != Resource.FILE
+    return resource.type not in (Resource.FILE, Resource.DIR)
 
 
 def _grass_map_exists(planner, resource):
@@ -277,14 +1313,32 @@ def _creator_visible(planner, resource):
 
 
 def _creator_changed(planner, resource):
-    '''Returns true if the creator of a map has changed.'''
-    parent_status = planner.statuses[planner.created[resource.ref()]]
-    return parent_status != TaskStatus.SKIP
+    '''Returns true if a map has changed since the task last used it.
+
+    Without digests, the map has changed if its creator was run.
+    '''
+    ref = resource.ref()
+    used = planner.history.get(planner.task.hash, {}).get('used', {}).get(ref)
+    current = planner.digests.get(ref)
+    if used is not None and current is not None:
+        return used != current
+    parent_status = planner.statuses.get(planner.created[ref])
+    return parent_status not in (None, TaskStatus.SKIP)
+
+
+def _input_cleaned(planner, resource):
+    '''Returns true if a missing input is a temporary that was cleaned up.'''
+    return resource.ref() in planner.cleaned
+
+
+def _output_cleaned(planner, resource):
+    '''Returns true if a missing output is a temporary that was cleaned up.'''
+    return resource.ref() in _cleaned(planner.history, planner.task)
 
 
 def _is_file(_, resource):
-    '''Returns true if the resource is a file.'''
-    return resource.type == Resource.FILE
+    '''Returns true if the resource is a file, glob or directory.'''
+    return resource.type in (Resource.FILE, Resource.DIR)
 
 
 def _file_exists(planner, resource):
@@ -293,24 +1347,42 @@ def _file_exists(planner, resource):
 
 
 def _file_has_previous(planner, resource):
-    '''Returns true if the task has seen the file before.'''
+    '''Returns true if the task has seen the file, or dataset, before.'''
     history = planner.history.get(planner.task.hash, {}).get('inputs', {})
     return resource.ref() in history
 
 
+def _is_dataset(_, resource):
+    '''Returns true if the resource is a space time dataset.'''
+    return resource.type in Resource.DATASETS
+
+
+def _dataset_changed(planner, resource):
+    '''Returns true if maps of a dataset are registered, changed or removed.'''
+    history = planner.history[planner.task.hash]
+    previous = history['inputs'][resource.ref()]
+    current = planner.platform.dataset_maps(resource.type, resource.name)
+    return dict(current) != previous
+
+
 def _file_mtime_recent(planner, resource):
-    '''Returns true if a file has been more recently modified.'''
+    '''Returns true if a file has been more recently modified.
+
+    Directories and globs are modified when their manifest is different.
+    '''
     history = planner.history[planner.task.hash]
     previous = history['inputs'][resource.ref()]
-    current = planner.platform.file_mtime(resource.path)
+    current = _file_fingerprint(planner.platform, resource)
+    if resource.collection():
+        return current != previous
     if current > previous:
         return True
     return False
 
 
-def _task_always(_, task):
-    '''Return true if the task is marked as "always".'''
-    return task.always
+def _task_always(planner, task):
+    '''Return true if the task is marked as "always", or invalidated.'''
+    return task.always or task.ref in planner.invalidated
 
 
 _OUTPUT_DECISION_TREE = decision(
@@ -318,21 +1390,29 @@ _OUTPUT_DECISION_TREE = decision(
     true=decision(
         test=_grass_map_exists,
         true=decision(result=OutputStatus.EXISTS),
-        false=decision(result=None),
+        false=decision(
+            test=_output_cleaned,
+            true=decision(result=OutputStatus.CLEANED),
+            false=decision(result=None),
+        ),
     ),
     false=decision(
         test=_is_file,
         true=decision(
             test=_file_exists,
             true=decision(result=OutputStatus.EXISTS),
-            false=decision(result=None),
+            false=decision(
+                test=_output_cleaned,
+                true=decision(result=OutputStatus.CLEANED),
+                false=decision(result=None),
+            ),
         ),
         false=decision(result=None),
     )
 )
 
 
-_INPUT_DECISION_TREE = decision(
+_MAP_INPUT_DECISION_TREE = decision(
     test=_is_grass_map,
     true=decision(
         test=_grass_map_exists,
@@ -345,7 +1425,11 @@ _INPUT_DECISION_TREE = decision(
             ),
             false=decision(result=InputStatus.UNKNOWN),
         ),
-        false=decision(result=InputStatus.FAIL)
+        false=decision(
+            test=_input_cleaned,
+            true=decision(result=InputStatus.NOCHANGE),
+            false=decision(result=InputStatus.FAIL),
+        )
     ),
     false=decision(
         test=_is_file,
@@ -360,27 +1444,74 @@ _INPUT_DECISION_TREE = decision(
                 ),
                 false=decision(result=InputStatus.CHANGE)
             ),
-            false=decision(result=InputStatus.FAIL)
+            false=decision(
+                test=_input_cleaned,
+                true=decision(result=InputStatus.NOCHANGE),
+                false=decision(result=InputStatus.FAIL),
+            )
         ),
         false=decision(result=InputStatus.FAIL)
     )
 )
 
 
+_INPUT_DECISION_TREE = decision(
+    test=_is_dataset,
+    true=decision(
+        test=_grass_map_exists,
+        true=decision(
+            test=_file_has_previous,
+            true=decision(
+                test=_dataset_changed,
+                true=decision(result=InputStatus.CHANGE),
+                false=decision(result=InputStatus.NOCHANGE),
+            ),
+            false=decision(result=InputStatus.CHANGE),
+        ),
+        false=decision(
+            test=_input_cleaned,
+            true=decision(result=InputStatus.NOCHANGE),
+            false=decision(result=InputStatus.FAIL),
+        )
+    ),
+    false=_MAP_INPUT_DECISION_TREE,
+)
+
+
+def _forced(planner, _):
+    return planner.force
+
+
+def _only_given(planner, _):
+    return planner.only is not None
+
+
+def _is_only(planner, task):
+    return task.ref == planner.only
+
+
+def _skip_given(planner, _):
+    return planner.skip is not None
+
+
+def _is_skipped(planner, task):
+    return task.ref in planner.skip
+
+
 _TASK_DECISION_TREE = decision(
-    test=lambda p, _: p.force,
+    test=_forced,
     true=decision(result=TaskStatus.RUN),
     false=decision(
-        test=lambda p, _: p.only is not None,
+        test=_only_given,
         true=decision(
-            test=lambda p, t: t.ref == p.only,
+            test=_is_only,
             true=decision(result=TaskStatus.RUN),
             false=decision(result=TaskStatus.SKIP),
         ),
         false=decision(
-            test=lambda p, _: p.skip is not None,
+            test=_skip_given,
             true=decision(
-                test=lambda p, t: t.ref in p.skip,
+                test=_is_skipped,
                 true=decision(result=TaskStatus.SKIP),
                 false=decision(
                     test=_task_always,
@@ -398,133 +1529,649 @@ _TASK_DECISION_TREE = decision(
 )
 
 
+_TASK_REASONS = {
+    ('_forced', True): 'forced to run',
+    ('_is_only', True): 'the only task to run',
+    ('_is_only', False): 'not the only task to run',
+    ('_is_skipped', True): 'skipped',
+}
+
+_INPUT_REASONS = {
+    ('_creator_changed', True): 'input {ref} was changed by task {creator}',
+    ('_creator_visible', False): 'input {ref} is not created by the pipeline',
+    ('_input_cleaned', False): 'input {ref} does not exist',
+    ('_is_file', False): 'input {ref} is not a map or file',
+    ('_file_has_previous', False): 'input {ref} is new to the task',
+    ('_file_mtime_recent', True): 'input {ref} was modified, from {previous} '
+                                  'to {current}',
+    ('_dataset_changed', True): 'maps of input {ref} were registered, '
+                                'changed or removed',
+}
+
+
+def _short(value):
+    '''Shorten checksums for display.'''
+    return value[:8] if isinstance(value, (str, type(u''))) else value
+
+
+def _input_reason(planner, task, resource):
+    '''Explain the last decision made about an input.'''
+    (name, _, outcome) = planner.path[-1]
+    previous = current = None
+    if name == '_file_mtime_recent':
+        previous = planner.history[task.hash]['inputs'][resource.ref()]
+        current = _file_fingerprint(planner.platform, resource)
+    return _INPUT_REASONS[(name, outcome)].format(
+        ref=resource.ref(), creator=planner.created.get(resource.ref()),
+        previous=_short(previous), current=_short(current))
+
+
+def _because(planner, status, reason):
+    planner.reason = reason
+    return status
+
+
 def _task_status(planner, task):
-    '''Return a status for a task.'''
+    '''Return a status for a task, explained in ``planner.reason``.'''
     status = _TASK_DECISION_TREE(planner, task)
     if status:
-        return status
+        (name, _, outcome) = planner.path[-1]
+        reason = _TASK_REASONS.get((name, outcome))
+        if reason is None:
+            reason = ('marked always' if task.always else
+                      'downstream of an invalidated resource')
+        return _because(planner, status, reason)
 
     # Look at the outputs
     non_existing = []
+    cleaned = []
     for resource in task.outputs:
         status = _OUTPUT_DECISION_TREE(planner, resource)
-        if status != OutputStatus.EXISTS:
+        if status == OutputStatus.CLEANED:
+            cleaned.append(resource)
+        elif status != OutputStatus.EXISTS:
             non_existing.append(resource)
     if non_existing:
-        return TaskStatus.RUN
+        return _because(planner, TaskStatus.RUN, 'output {} does not exist'
+                        .format(non_existing[0].ref()))
 
     # Look at the history
     if task.hash not in planner.history:
-        return TaskStatus.RUN
+        return _because(planner, TaskStatus.RUN,
+                        'not run before with the same params, or upstream '
+                        'tasks')
 
     # Look at the current region
     region_hash = planner.platform.region_hash()
-    if planner.history[task.hash]['region'] != region_hash:
-        return TaskStatus.RUN
+    previous = planner.history[task.hash]['region']
+    if previous != region_hash:
+        return _because(planner, TaskStatus.RUN,
+                        'region changed from {} to {}'.format(
+                            _short(previous), _short(region_hash)))
+
+    # Look at the code run by the task
+    if _code_changed(planner, task):
+        return _because(planner, TaskStatus.RUN,
+                        'code changed from {} to {}'.format(
+                            _short(planner.history[task.hash].get('code')),
+                            _short(planner.fingerprint(task))))
 
     # Look at the inputs
     failures = []
     unknowns = []
-    result = TaskStatus.SKIP
+    changes = []
     for resource in task.inputs:
         status = _INPUT_DECISION_TREE(planner, resource)
         if status == InputStatus.FAIL:
-            failures.append(resource)
+            failures.append(_input_reason(planner, task, resource))
         elif status == InputStatus.UNKNOWN:
-            unknowns.append(resource)
+            unknowns.append(_input_reason(planner, task, resource))
         elif status == InputStatus.CHANGE:
-            result = TaskStatus.RUN
+            changes.append(_input_reason(planner, task, resource))
     if failures:
-        return TaskStatus.FAIL
+        return _because(planner, TaskStatus.FAIL, failures[0])
     if unknowns:
+        return _because(planner, TaskStatus.RUN, unknowns[0])
+    if changes:
+        return _because(planner, TaskStatus.RUN, changes[0])
+
+    # Recreate temporary outputs only if they will be used
+    if cleaned and _consumers_needed(planner, task, cleaned):
+        return _because(planner, TaskStatus.RUN,
+                        'temporary output {} is needed by a later task'
+                        .format(cleaned[0].ref()))
+    return _because(planner, TaskStatus.SKIP,
+                    'outputs exist and inputs are unchanged')
+
+
+def _missing_temporary(planner, task):
+    '''Fail a task to be run that uses a temporary, cleaned up, input.
+
+    Happens when the task that creates the input was skipped, as the task was
+    not expected to run.
+    '''
+    for resource in task.inputs:
+        if resource.ref() in planner.cleaned:
+            return _because(planner, TaskStatus.FAIL,
+                            'temporary input {} was removed, and task {} was '
+                            'not run to recreate it'.format(
+                                resource.ref(),
+                                planner.created.get(resource.ref())))
+    return task.status
+
+
+def _cleaned(history, task):
+    '''Return the temporary outputs of a task that have been cleaned up.'''
+    return set(history.get(task.hash, {}).get('cleaned', []))
+
+
+def _code_changed(planner, task):
+    '''Returns true if the code run by a task has changed, when tracked.
+
+    A task without a recorded fingerprint is taken as unchanged, the
+    fingerprint recorded after it completes is the baseline.
+    '''
+    if planner.fingerprint is None:
+        return False
+    previous = planner.history[task.hash].get('code')
+    return previous is not None and previous != planner.fingerprint(task)
+
+
+def _task_needed(planner, task, origin):
+    '''Predict if a task, later in the pipeline, is likely to be run.
+
+    Only what is known before the tasks in between, after the ``origin`` task
+    being analysed, have been analysed is considered. Those creating inputs of
+    the task are predicted in turn.
+    '''
+    if planner.force:
+        return True
+    if planner.only is not None:
+        return task.ref == planner.only
+    if planner.skip and task.ref in planner.skip:
+        return False
+    if _task_always(planner, task) or task.hash not in planner.history:
+        return True
+
+    region_hash = planner.platform.region_hash()
+    if planner.history[task.hash]['region'] != region_hash:
+        return True
+    if _code_changed(planner, task):
+        return True
+
+    (current, path) = (planner.task, planner.path)
+    planner.task = task
+    planner.path = []
+    try:
+        for resource in task.outputs:
+            status = _OUTPUT_DECISION_TREE(planner, resource)
+            if status not in (OutputStatus.EXISTS, OutputStatus.CLEANED):
+                return True
+        for resource in task.inputs:
+            if resource.type in (Resource.FILE, Resource.DIR):
+                status = _INPUT_DECISION_TREE(planner, resource)
+                if status != InputStatus.NOCHANGE:
+                    return True
+                continue
+            producer = planner.index.producer_of(task, resource)
+            if (producer is not None and producer.ref != origin.ref and
+                    producer.ref not in planner.statuses):
+                if _task_needed(planner, producer, origin):
+                    return True
+                continue
+            if (_creator_visible(planner, resource) and
+                    _creator_changed(planner, resource)):
+                return True
+    finally:
+        planner.task = current
+        planner.path = path
+    return False
+
+
+def _consumers_needed(planner, task, resources):
+    '''Returns true if any task using the resources is likely to be run.'''
+    if planner.index is None:
+        return True
+    for resource in resources:
+        for consumer in planner.index.consumers_of(task, resource):
+            if _task_needed(planner, consumer, task):
+                return True
+    return False
+
+
+def _pipeline_code(planner, pipeline):
+    '''Return the fingerprints of the code run by a sub-pipeline.'''
+    return {task.task: planner.fingerprint(task) for task in pipeline.tasks}
+
+
+def _pipeline_status(planner, pipeline):
+    '''Return a status for a whole sub-pipeline.
+
+    A sub-pipeline is skipped, without looking at any of its tasks, when its
+    aggregate hash has been seen before in the same region, the code of its
+    tasks is unchanged, when tracked, its external inputs are unchanged and
+    all of its outputs still exist.
+    '''
+    if planner.force or pipeline.always:
+        return TaskStatus.RUN
+    prefix = '{}/'.format(pipeline.ref)
+    if planner.only is not None and planner.only.startswith(prefix):
+        return TaskStatus.RUN
+    if any(ref.startswith(prefix) for ref in planner.invalidated):
         return TaskStatus.RUN
-    return result
+    if pipeline.hash not in planner.history:
+        return TaskStatus.RUN
+
+    region_hash = planner.platform.region_hash()
+    if planner.history[pipeline.hash]['region'] != region_hash:
+        return TaskStatus.RUN
+    if planner.fingerprint is not None:
+        previous = planner.history[pipeline.hash].get('code')
+        if previous is not None and previous != _pipeline_code(planner,
+                                                               pipeline):
+            return TaskStatus.RUN
+
+    (current, path) = (planner.task, planner.path)
+    planner.task = pipeline
+    planner.path = []
+    try:
+        for resource in pipeline.outputs:
+            status = _OUTPUT_DECISION_TREE(planner, resource)
+            if status != OutputStatus.EXISTS:
+                return TaskStatus.RUN
+        for resource in pipeline.inputs:
+            status = _INPUT_DECISION_TREE(planner, resource)
+            if status != InputStatus.NOCHANGE:
+                return TaskStatus.RUN
+    finally:
+        planner.task = current
+        planner.path = path
+    return TaskStatus.SKIP
+
+
+def _summarise(pipeline, events):
+    '''Fill in the aggregate hash, inputs and outputs of a pipeline.'''
+    hashes = []
+    tasks = collections.OrderedDict()
+    inputs = collections.OrderedDict()
+    outputs = collections.OrderedDict()
+    for event in events:
+        if isinstance(event, TaskEvent):
+            hashes.append(event.hash)
+            tasks.setdefault(event.task, event)
+            pipeline.always = pipeline.always or event.always
+            for resource in event.inputs:
+                if resource.ref() not in outputs:
+                    inputs.setdefault(resource.ref(), resource)
+            for resource in event.outputs:
+                outputs[resource.ref()] = resource
+            for resource in event.removes + event.temporary:
+                outputs.pop(resource.ref(), None)
+        elif isinstance(event, LocationEvent):
+            hashes.append([event.gisdbase, event.location, event.mapset])
+    pipeline.tasks = list(tasks.values())
+    pipeline.inputs = list(inputs.values())
+    pipeline.outputs = list(outputs.values())
+    pipeline.hash = _object_checksum({
+        'location': [pipeline.gisdbase, pipeline.location, pipeline.mapset],
+        'tasks': hashes,
+    })
+
+
+_EXECUTION_OPTIONS = ('nprocs', 'memory', 'compressor', 'omp_threads')
+# Fraction of available memory used by an 'auto' execution profile
+_MEMORY_FRACTION = 0.75
+# Always available since GRASS GIS 7.4
+_DEFAULT_COMPRESSOR = 'LZ4'
+
+
+def _merge_execution(*profiles):
+    '''Merge execution profiles, later profiles taking precedence.
+
+    A profile may be the string ``'auto'``, as shorthand for all options.
+    '''
+    merged = {}
+    for profile in profiles:
+        if profile == 'auto':
+            profile = {option: 'auto' for option in _EXECUTION_OPTIONS}
+        merged.update(profile or {})
+    return merged
 
 
-def load(jinja_env, options, gisdbase=None, location=None, mapset='PERMANENT'):
-    '''Load all tasks from a pipeline.
+def _available_memory():
+    '''Return the available memory in megabytes, or None if unknown.'''
+    try:
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except IOError:
+        pass
+    try:
+        pages = os.sysconf('SC_AVPHYS_PAGES')
+        return pages * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
 
-    This expands a pipeline, and all of sub-pipelines and location changes into
-    a normalized, flat series, of events.
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+
+def resolve_execution(execution, cpus=None, memory=None):
+    '''Resolve the ``'auto'`` values of an execution profile.
+
+    Threads default to the number of usable cores and memory to a fraction of
+    the available memory, in megabytes.
     '''
-    stack = [('config', (None, None, options))]
-    locations = []
+    resolved = dict(execution)
+    if resolved.get('nprocs') == 'auto':
+        resolved['nprocs'] = cpus or _cpu_count()
+    if resolved.get('omp_threads') == 'auto':
+        resolved['omp_threads'] = resolved.get('nprocs') or cpus or \
+            _cpu_count()
+    if resolved.get('memory') == 'auto':
+        available = memory or _available_memory()
+        resolved['memory'] = (int(available * _MEMORY_FRACTION)
+                              if available else None)
+    if resolved.get('compressor') == 'auto':
+        resolved['compressor'] = _DEFAULT_COMPRESSOR
+    return resolved
+
+
+
+@contextlib.contextmanager
+def _execution_environment(execution):
+    '''Set the environment variables of an execution profile.'''
+    variables = {}
+    if execution.get('compressor'):
+        variables['GRASS_COMPRESSOR'] = str(execution['compressor'])
+    if execution.get('omp_threads'):
+        variables['OMP_NUM_THREADS'] = str(execution['omp_threads'])
+    previous = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for (name, value) in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
 
-    while stack:
-        tag, data = stack.pop()
-        if tag == 'location':
-            yield data
-            continue
 
-        (parent, ref, options) = data
+def _accepts(function, name):
+    '''Returns true if a function explicitly declares a named argument.'''
+    try:
+        parameters = inspect.signature(function).parameters
+    except AttributeError:
+        # pylint: disable=deprecated-method
+        return name in inspect.getargspec(function).args
+    except ValueError:
+        return False
+    parameter = parameters.get(name)
+    return parameter is not None and parameter.kind in (
+        parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY)
 
-        if 'pipeline' in options:
-            name = options.get('pipeline')
-            params = options.get('params', {})
 
-            variables = params.get('vars', {})
-            gisdbase_ = params.get('gisdbase', gisdbase)
-            location_ = params.get('location', location)
-            mapset_ = params.get('mapset', mapset)
+class _Loader(object):
+    '''Expands pipelines into a flat series of events.'''
+
+    def __init__(self, jinja_env):
+        self.jinja_env = jinja_env
+        # Hash of the task that last created a resource
+        self.producers = {}
 
-            template = jinja_env.get_template(name)
+    def expand(self, parent, ref, options, location):
+        if 'pipeline' in options:
+            for event in self._pipeline(ref, options, location):
+                yield event
+        elif 'task' in options:
+            yield self._task(parent, ref, options, location)
+
+    def _pipeline(self, ref, options, location):
+        started = _clock()
+        name = options.get('pipeline')
+        params = options.get('params', {})
+
+        variables = params.get('vars', {})
+        gisdbase = params.get('gisdbase', location.gisdbase)
+        location_ = params.get('location', location.location)
+        mapset = params.get('mapset', location.mapset)
+
+        if _is_callable_ref(name):
+            # Python generators produce their tasks lazily, and are therefore
+            # streamed rather than expanded and summarised up front.
+            generator = _import_callable(name)
+            config = {'tasks': generator(**variables)}
+            summarise = False
+        else:
+            template = self.jinja_env.get_template(name)
             config = toml.loads(template.render(variables))
+            summarise = ref is not None
+
+        pipeline = PipelineEvent(
+            gisdbase=config.get('gisdbase', gisdbase),
+            location=config.get('location', location_),
+            mapset=config.get('mapset', mapset),
+            pipeline=name,
+            ref=ref,
+            execution=_merge_execution(location.execution,
+                                       config.get('execution'),
+                                       options.get('execution')))
+
+        events = self._tasks(name, ref, config.get('tasks', []), pipeline)
+        if summarise:
+            # Sub-pipelines are expanded up front so that they may be skipped
+            # as a whole when nothing within them has changed.
+            events = list(events)
+            _summarise(pipeline, events)
+        pipeline.loading = _clock() - started
+
+        yield pipeline
+        for event in events:
+            yield event
 
-            location = LocationEvent(
-                gisdbase=config.get('gisdbase', gisdbase_),
-                location=config.get('location', location_),
-                mapset=config.get('mapset', mapset_))
-            yield location
-            if locations:
-                stack.append(('location', locations.pop()))
-            locations.append(location)
+        if ref is not None:
+            yield LocationEvent(gisdbase=location.gisdbase,
+                                location=location.location,
+                                mapset=location.mapset)
+
+    def _tasks(self, name, ref, tasks, location):
+        for (i, task) in enumerate(tasks):
+            tref = str(i) if ref is None else '{}/{}'.format(ref, i)
+            for event in self.expand(name, tref, task, location):
+                yield event
+
+    def _task(self, parent, ref, options, location):
+        contributing = ['task', 'params', 'inputs', 'outputs', 'removes']
+        hashable = {name: options.get(name) for name in contributing}
+        # Fold in the hashes of the tasks that created the inputs, so any
+        # change to a task invalidates everything downstream of it.
+        hashable['upstream'] = [self.producers.get(ref_)
+                                for ref_ in options.get('inputs', [])]
+        hash_ = _object_checksum(hashable)
+
+        inputs = [Resource(ref_) for ref_ in options.get('inputs', [])]
+        outputs = [Resource(ref_) for ref_ in options.get('outputs', [])]
+        removes = [Resource(ref_) for ref_ in options.get('removes', [])]
+
+        temporary = []
+        for ref_ in options.get('temporary', []):
+            if ref_ not in options.get('outputs', []):
+                raise Error('Temporary resource "{}" is not an output, in "{}" '
+                            'at "{}"'.format(ref_, parent, ref))
+            temporary.append(Resource(ref_))
+        scratch = options.get('scratch', False)
+        if scratch:
+            # Scratch mapsets do not outlive the session
+            temporary = list(outputs)
+
+        for resource in outputs:
+            self.producers[resource.ref()] = hash_
+        for resource in removes:
+            self.producers.pop(resource.ref(), None)
+
+        return TaskEvent(options['task'],
+                         pipeline=parent,
+                         ref=ref,
+                         hash_=hash_,
+                         message=options.get('message', ''),
+                         params=options.get('params', {}),
+                         always=options.get('always', False),
+                         execution=_merge_execution(location.execution,
+                                                    options.get('execution')),
+                         inputs=inputs,
+                         outputs=outputs,
+                         removes=removes,
+                         temporary=temporary,
+                         scratch=scratch)
 
-            tasks = list(enumerate(list(config.get('tasks', []))))
-            for (i, task) in reversed(tasks):
-                tref = str(i) if ref is None else '{}/{}'.format(ref, i)
-                stack.append(('config', (name, tref, task)))
 
-        elif 'task' in options:
-            contributing = ['task', 'params', 'inputs', 'outputs', 'removes']
-            hashable = {name: options.get(name) for name in contributing}
-            hash_ = _object_checksum(hashable)
-
-            inputs = [Resource(ref) for ref in options.get('inputs', [])]
-            outputs = [Resource(ref) for ref in options.get('outputs', [])]
-            removes = [Resource(ref) for ref in options.get('removes', [])]
-
-            yield TaskEvent(options['task'],
-                            pipeline=parent,
-                            ref=ref,
-                            hash_=hash_,
-                            message=options.get('message', ''),
-                            params=options.get('params', {}),
-                            always=options.get('always', False),
-                            inputs=inputs,
-                            outputs=outputs,
-                            removes=removes,)
-
-
-def analyse(stream, platform, history, force=None, skip=None, only=None):
+def load(jinja_env, options, gisdbase=None, location=None, mapset='PERMANENT'):
+    '''Load all tasks from a pipeline.
+
+    This expands a pipeline, and all of sub-pipelines and location changes into
+    a normalized, flat series, of events. Each sub-pipeline starts with a
+    ``PipelineEvent`` and ends with a ``LocationEvent`` restoring the location
+    of its parent.
+    '''
+    loader = _Loader(jinja_env)
+    initial = PipelineEvent(gisdbase=gisdbase,
+                            location=location,
+                            mapset=mapset)
+    return loader.expand(None, None, options, initial)
+
+
+def _task_changes(planner, task):
+    '''Return the maps of each input dataset that are new to a task.'''
+    previous = planner.history.get(task.hash, {}).get('inputs', {})
+    changes = {}
+    for resource in task.inputs:
+        if resource.type not in Resource.DATASETS:
+            continue
+        maps = planner.platform.dataset_maps(resource.type, resource.name)
+        if maps is not None:
+            changes[resource.ref()] = _dataset_changes(
+                previous.get(resource.ref()), maps)
+    return changes
+
+
+def _record_pipeline(planner, pipeline):
+    '''Update the history of a pipeline that has been fully executed.'''
+    platform = planner.platform
+    pipeline_history = {
+        'region': platform.region_hash(),
+        'pipeline': pipeline.pipeline,
+        'inputs': {},
+    }
+    if planner.fingerprint is not None:
+        pipeline_history['code'] = _pipeline_code(planner, pipeline)
+    for resource in pipeline.inputs:
+        if resource.type in (Resource.FILE, Resource.DIR):
+            pipeline_history['inputs'][resource.ref()] = _file_fingerprint(
+                platform, resource)
+        elif resource.type in Resource.DATASETS:
+            maps = platform.dataset_maps(resource.type, resource.name)
+            if maps is not None:
+                pipeline_history['inputs'][resource.ref()] = dict(maps)
+    planner.history[pipeline.hash] = pipeline_history
+
+
+def analyse(stream, platform, history, force=None, skip=None, only=None,
+            index=None, invalidated=None, fingerprint=None):
     '''Analyse the stream of tasks to be run.
 
     Responsible for setting the status field of a task, determining if it
-    should be run or not.
+    should be run or not. An ``Index`` of the whole pipeline allows temporary
+    outputs, that have been cleaned up, to be recreated only when needed.
+    Tasks referenced in ``invalidated``, eg. from ``Index.downstream``, are
+    run as if marked "always". Tasks are also run when the result of
+    ``fingerprint``, eg. ``TaskRegistry.fingerprint``, differs from their
+    previous run.
     '''
-    planner = StatusContext(platform, history, skip, force, only)
+    planner = StatusContext(platform, history, skip, force, only,
+                            index=index, invalidated=invalidated,
+                            fingerprint=fingerprint)
     completed = set()
+    pipelines = []
+    skipping = None
 
     for event in stream:
+        if isinstance(event, PipelineEvent):
+            pipelines.append(event)
+            yield event
+            # Checked once the session has switched to the pipeline's location
+            if (skipping is None and event.hash is not None and
+                    _pipeline_status(planner, event) == TaskStatus.SKIP):
+                skipping = event
+            continue
+
+        if isinstance(event, LocationEvent):
+            # Returning to the parent location closes the current pipeline
+            if pipelines:
+                pipeline = pipelines.pop()
+                if pipeline.hash is not None:
+                    if skipping is None:
+                        _record_pipeline(planner, pipeline)
+                    elif (fingerprint is not None and
+                          pipeline.hash in history):
+                        # Unchanged, so the current code is the baseline
+                        history[pipeline.hash].setdefault(
+                            'code', _pipeline_code(planner, pipeline))
+                    completed.add(pipeline.hash)
+                if skipping is pipeline:
+                    skipping = None
+            yield event
+            continue
+
         if not isinstance(event, TaskEvent):
             yield event
             continue
 
         task = event
         planner.task = task
+
+        if skipping is not None:
+            planner.task.status = TaskStatus.SKIP
+            planner.statuses[task.ref] = task.status
+            task.reason = 'pipeline {} is unchanged'.format(skipping.ref)
+            yield task
+            completed.add(task.hash)
+            for resource in task.outputs:
+                planner.created[resource.ref()] = task.ref
+            for resource in task.removes:
+                planner.created.pop(resource.ref(), None)
+                planner.digests.pop(resource.ref(), None)
+            planner.cleaned.update(_cleaned(history, task))
+            planner.digests.update(history.get(task.hash, {}).get(
+                'outputs', {}))
+            if fingerprint is not None and task.hash in history:
+                history[task.hash].setdefault('code', fingerprint(task))
+            continue
+
+        started = _clock()
+        planner.path = []
         planner.task.status = _task_status(planner, task)
+        if task.status == TaskStatus.RUN:
+            task.status = _missing_temporary(planner, task)
         planner.statuses[task.ref] = task.status
+        task.reason = planner.reason
+        task.decisions = planner.path
+        planner.path = []
 
         region_hash = platform.region_hash()
+        task.planned = started
+        task.planning = _clock() - started
+
+        if task.status == TaskStatus.RUN:
+            # Any temporary outputs will be recreated
+            history.get(task.hash, {}).pop('cleaned', None)
+            task.changes = _task_changes(planner, task)
 
         yield task
 
@@ -533,17 +2180,39 @@ def analyse(stream, platform, history, force=None, skip=None, only=None):
         # Advance planner state
         for resource in task.outputs:
             planner.created[resource.ref()] = task.ref
+            planner.cleaned.discard(resource.ref())
         for resource in task.removes:
             del planner.created[resource.ref()]
+            planner.digests.pop(resource.ref(), None)
+        if task.status == TaskStatus.SKIP:
+            planner.cleaned.update(_cleaned(history, task))
+            planner.digests.update(history.get(task.hash, {}).get(
+                'outputs', {}))
 
         # Update the history
         task_history = history.get(task.hash, {'inputs': {}})
         task_history['region'] = region_hash
         task_history['message'] = task.message
+        task_history['task'] = task.task
+        if task.duration is not None:
+            task_history['duration'] = task.duration
         for resource in task.inputs:
-            if resource.type == Resource.FILE:
-                task_history['inputs'][resource.ref()] = platform.file_mtime(
-                    resource.path)
+            if resource.type in (Resource.FILE, Resource.DIR):
+                task_history['inputs'][resource.ref()] = _file_fingerprint(
+                    platform, resource)
+            elif (resource.type in Resource.DATASETS and
+                  task.status == TaskStatus.RUN):
+                # Maps not yet processed, eg. with --skip, are kept pending
+                maps = platform.dataset_maps(resource.type, resource.name)
+                if maps is not None:
+                    task_history['inputs'][resource.ref()] = dict(maps)
+        if task.status == TaskStatus.RUN:
+            _record_used(planner, task, task_history)
+            _record_outputs(planner, task, task_history)
+            if fingerprint is not None:
+                task_history['code'] = fingerprint(task)
+        elif fingerprint is not None:
+            task_history.setdefault('code', fingerprint(task))
         history[task.hash] = task_history
 
     # Remove previously seen keys.
@@ -553,33 +2222,467 @@ def analyse(stream, platform, history, force=None, skip=None, only=None):
             del history[key]
 
 
-def _load_task(task):
-    name = task.task
+# What an ``Index`` keeps of each task, without its params
+IndexedTask = collections.namedtuple('IndexedTask', [
+    'ref', 'task', 'pipeline', 'hash', 'always', 'scratch', 'inputs',
+    'outputs', 'removes', 'temporary'])
+
+
+class Index(object):
+    '''Relates resources to the tasks that create and use them.
+
+    Only the references, resources and hashes of tasks are kept, so that a
+    pipeline may be indexed as it is streamed.
+    '''
+
+    def __init__(self):
+        self.producers = collections.defaultdict(list)
+        self.consumers = collections.defaultdict(list)
+        # Temporary resources to remove after a task, with their producer
+        self.expiry = collections.defaultdict(list)
+        self.tasks = []
+        self._positions = {}
+        self._uses = {}
+        self._pending = collections.OrderedDict()
+
+    @classmethod
+    def build(cls, stream):
+        index = cls()
+        for event in stream:
+            if isinstance(event, TaskEvent):
+                index.add(event)
+        index.finish()
+        return index
+
+    def _close(self, ref, expire):
+        pending = self._pending.pop(ref, None)
+        if pending is None:
+            return
+        (resource, producer, consumers) = pending
+        self._uses[(producer.ref, ref)] = consumers
+        if expire:
+            last = consumers[-1] if consumers else producer
+            self.expiry[last.ref].append((resource, producer))
+
+    def add(self, event):
+        task = IndexedTask(event.ref, event.task, event.pipeline, event.hash,
+                           event.always, event.scratch, event.inputs,
+                           event.outputs, event.removes, event.temporary)
+        self._positions[task.ref] = len(self.tasks)
+        self.tasks.append(task)
+        for resource in task.inputs:
+            self.consumers[resource.ref()].append(task)
+            if resource.ref() in self._pending:
+                self._pending[resource.ref()][2].append(task)
+        # Temporaries removed, or replaced, by a task need no cleaning up
+        for resource in task.removes + task.outputs:
+            self._close(resource.ref(), False)
+        for resource in task.outputs:
+            self.producers[resource.ref()].append(task)
+        for resource in task.temporary:
+            self._pending[resource.ref()] = (resource, task, [])
+
+    def finish(self):
+        for ref in list(self._pending.keys()):
+            self._close(ref, True)
+
+    def consumers_of(self, task, resource):
+        '''Return the tasks using a temporary resource created by a task.'''
+        return self._uses.get((task.ref, resource.ref()), [])
+
+    def producer_of(self, task, resource):
+        '''Return the last task creating a resource before a task.'''
+        position = self._positions[task.ref]
+        producers = [producer for producer in
+                     self.producers.get(resource.ref(), [])
+                     if self._positions[producer.ref] < position]
+        return producers[-1] if producers else None
+
+    def downstream(self, refs):
+        '''Return the tasks transitively affected by changes to resources.
+
+        Tasks are returned in pipeline order. A file also affects the globs
+        and directories that contain it. Resources recreated by a task that
+        is not affected are no longer considered changed after it.
+        '''
+        changed = set(refs)
+        files = [Resource(ref) for ref in refs
+                 if ref.startswith('{}/'.format(Resource.FILE))]
+        affected = []
+        for task in self.tasks:
+            if any(resource.ref() in changed or
+                   any(_file_contains(resource, f) for f in files)
+                   for resource in task.inputs):
+                affected.append(task)
+                changed.update(r.ref() for r in task.outputs)
+            else:
+                changed.difference_update(
+                    r.ref() for r in task.outputs + task.removes)
+        return affected
+
+
+def _file_contains(resource, changed):
+    '''Returns true if a glob or directory resource contains a changed file.'''
+    if not resource.collection() or changed.collection():
+        return False
+    (directory, name) = os.path.split(changed.path)
+    if os.path.normpath(directory or os.curdir) != \
+            os.path.normpath(resource.path):
+        return False
+    return resource.pattern is None or fnmatch.fnmatch(name, resource.pattern)
+
+
+def estimate_durations(tasks, history):
+    '''Estimate the duration of tasks from their previous runs.
+
+    Tasks without a recorded duration are estimated from the average duration
+    of tasks with the same name, or ``None`` when there are none.
+    '''
+    samples = collections.defaultdict(list)
+    for entry in history.values():
+        if 'duration' in entry and 'task' in entry:
+            samples[entry['task']].append(entry['duration'])
+    estimates = collections.OrderedDict()
+    for task in tasks:
+        duration = history.get(task.hash, {}).get('duration')
+        if duration is None and samples.get(task.task):
+            durations = samples[task.task]
+            duration = sum(durations) / len(durations)
+        estimates[task.ref] = duration
+    return estimates
+
+
+def cleanup(stream, index, platform, history, batch=20, scratch=None):
+    '''Remove temporary resources once the last task using them has finished.
+
+    Resources are removed in batches, and recorded in the history of the task
+    that created them. Outputs of tasks run in the ``scratch`` mapset are
+    removed from there.
+    '''
+    statuses = {}
+    pending = []
+
+    def flush():
+        resources = []
+        mapsets = collections.OrderedDict()
+        for (resource, producer) in pending:
+            cleaned = _cleaned(history, producer)
+            if (statuses.get(producer.ref) == TaskStatus.SKIP and
+                    resource.ref() in cleaned):
+                continue
+            resources.append(resource)
+            mapset = scratch if producer.scratch else None
+            mapsets.setdefault(mapset, []).append(resource)
+            producer_history = history.setdefault(producer.hash,
+                                                  {'inputs': {}})
+            producer_history['cleaned'] = sorted(cleaned | {resource.ref()})
+        del pending[:]
+        if not resources:
+            return None
+        started = _clock()
+        for (mapset, group) in mapsets.items():
+            platform.remove(group, mapset)
+        return CleanupEvent(resources, _clock() - started)
+
+    for event in stream:
+        if isinstance(event, LocationEvent) and pending:
+            cleaned = flush()
+            if cleaned:
+                yield cleaned
+        yield event
+        if isinstance(event, (TaskCompleteEvent, TaskSkipEvent)):
+            statuses[event.task.ref] = event.task.status
+            pending.extend(index.expiry.get(event.task.ref, []))
+            if len(pending) >= batch:
+                cleaned = flush()
+                if cleaned:
+                    yield cleaned
+
+    cleaned = flush()
+    if cleaned:
+        yield cleaned
+
+
+def _task_entry_points(group):
+    '''Return the entry points registered under a group, by name.'''
     try:
-        return getattr(
-            importlib.import_module('stitches.tasks'), name)
-    except AttributeError:
-        (module, klass) = name.split(':')
+        from importlib import metadata
+    except ImportError:
+        import pkg_resources
+        return {ep.name: ep for ep in pkg_resources.iter_entry_points(group)}
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=group)
+    else:
+        entry_points = entry_points.get(group, [])
+    return {ep.name: ep for ep in entry_points}
+
+
+def _check_params(function, params):
+    '''Raise a ``TypeError`` if the params cannot be passed to a function.'''
+    if not isinstance(params, dict):
+        raise TypeError('params must be a table, not "{}"'.format(params))
+    try:
+        signature = inspect.signature(function)
+    except (AttributeError, ValueError):
+        # Signatures are unavailable for Python 2 and some builtins
+        return
+    signature.bind(**params)
+
+
+class TaskRegistry(object):
+    '''Resolves task names to python callables.
+
+    Task names are looked up in the ``stitches.tasks`` entry point group, then
+    in ``stitches.tasks`` itself and finally treated as a reference to an
+    importable ``package.module:function``. Resolved callables are cached.
+    '''
+    GROUP = 'stitches.tasks'
+    # Tasks whose results depend on the version of GRASS GIS
+    GRASS_TASKS = ('grass', 'grass_batch', 'grass_blocks', 'grass_link')
+
+    def __init__(self, entry_points=None, grass_version=None):
+        self.entry_points = entry_points
+        self.grass_version = grass_version
+        self.cache = {}
+        self._sources = {}
+
+    def _lookup(self, name):
+        if self.entry_points is None:
+            self.entry_points = _task_entry_points(TaskRegistry.GROUP)
+        if name in self.entry_points:
+            return self.entry_points[name].load()
+        builtin = getattr(importlib.import_module('stitches.tasks'), name, None)
+        if inspect.isfunction(builtin) and not name.startswith('_'):
+            return builtin
+        if _is_callable_ref(name):
+            return _import_callable(name)
+        raise ImportError(name)
+
+    def resolve(self, task):
+        '''Return the callable for a task.'''
+        name = task.task
+        if name not in self.cache:
+            try:
+                self.cache[name] = self._lookup(name)
+            except (ImportError, AttributeError):
+                raise Error('Task "{}" not found, in "{}" at "{}"'.format(
+                    task.task, task.pipeline, task.ref))
+        return self.cache[name]
+
+    def _source_checksum(self, function):
+        '''Return a checksum of the source of a callable.
+
+        Built-in tasks are covered by their own source, other callables by
+        the source file of their module.
+        '''
+        name = getattr(function, '__module__', None)
+        if name == 'stitches.tasks':
+            if function not in self._sources:
+                self._sources[function] = _object_checksum(
+                    inspect.getsource(function))
+            return self._sources[function]
+
+        module = sys.modules.get(name)
+        try:
+            path = inspect.getsourcefile(module or function)
+        except TypeError:
+            path = None
+        if path not in self._sources:
+            self._sources[path] = None
+            if path is not None:
+                self._sources[path] = _digest_files([path])
+        return self._sources[path]
+
+    def fingerprint(self, task):
+        '''Return a fingerprint of the code run by a task.
+
+        This covers the source of the task's callable and, for tasks running
+        GRASS GIS modules, the version of GRASS GIS.
+        '''
+        fingerprint = [self._source_checksum(self.resolve(task))]
+        if task.task in TaskRegistry.GRASS_TASKS:
+            fingerprint.append(self.grass_version)
+        return _object_checksum(fingerprint)
+
+    def validate(self, task):
+        '''Resolve a task and check that it accepts its params.'''
+        function = self.resolve(task)
         try:
-            return getattr(
-                importlib.import_module(module), klass)
-        except ImportError:
-            raise Error('Task "{}" not found, in "{}" at "{}"'.format(
-                task.task, task.pipeline, task.ref))
+            _check_params(function, task.params)
+        except TypeError as err:
+            raise Error('Invalid params for task "{}", in "{}" at "{}": {}'
+                        .format(task.task, task.pipeline, task.ref, err))
+        return function
+
+
+def _validated(stream, registry):
+    '''Pass on a stream of events, resolving each task as it goes.
+
+    All errors are collected and raised together, once the stream ends.
+    '''
+    errors = []
+    for event in stream:
+        if isinstance(event, TaskEvent):
+            try:
+                registry.validate(event)
+            except Error as err:
+                errors.append(err.message)
+        yield event
+    if errors:
+        raise Error('\n'.join(errors))
 
 
-def execute(stream, stdout, stderr):
+def validate(stream, registry):
+    '''Resolve every task in a stream before any of them are executed.
+
+    All errors are collected and raised together.
+    '''
+    for _ in _validated(stream, registry):
+        pass
+
+
+class Profiler(object):
+    '''Profiles the python callables of tasks.
+
+    Statistics from ``cProfile`` and, optionally, the top memory allocations
+    from ``tracemalloc`` are written to a directory per task reference.
+    '''
+
+    def __init__(self, directory, refs=None, memory=False, top=25):
+        self.directory = directory
+        # Profile every task when no references are given
+        self.refs = refs
+        self.memory = memory
+        self.top = top
+        self.stats = []
+
+    def _path(self, task, suffix):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        name = task.ref.replace('/', '_') if task.ref else task.task
+        return os.path.join(self.directory, '{}.{}'.format(name, suffix))
+
+    def _snapshot(self, task, tracemalloc):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        with open(self._path(task, 'allocations.txt'), 'w') as fp:
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                print(stat, file=fp)
+
+    def wrap(self, task, function):
+        '''Return the function, profiled if the task should be profiled.'''
+        if self.refs is not None and task.ref not in self.refs:
+            return function
+
+        def profiled(**kwargs):
+            tracemalloc = None
+            if self.memory:
+                try:
+                    import tracemalloc
+                except ImportError:
+                    raise Error('Memory profiling requires Python 3')
+                tracemalloc.start()
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return function(**kwargs)
+            finally:
+                profile.disable()
+                path = self._path(task, 'pstats')
+                profile.dump_stats(path)
+                self.stats.append(path)
+                if tracemalloc is not None:
+                    self._snapshot(task, tracemalloc)
+                    tracemalloc.stop()
+        return profiled
+
+    def summary(self):
+        '''Write the top functions, across all profiled tasks, to a file.'''
+        if not self.stats:
+            return None
+        path = os.path.join(self.directory, 'summary.txt')
+        with open(path, 'w') as fp:
+            stats = pstats.Stats(*self.stats, stream=fp)
+            stats.sort_stats('cumulative').print_stats(self.top)
+        return path
+
+
+@contextlib.contextmanager
+def _scratch_mapset(task, scratch):
+    '''Use the scratch mapset as the current mapset, if the task needs it.'''
+    if not task.scratch:
+        yield
+        return
+    if scratch is None:
+        raise Error('No scratch mapset for task "{}", in "{}" at "{}"'.format(
+            task.task, task.pipeline, task.ref))
+    from .session import use_mapset
+    with use_mapset(scratch):
+        yield
+
+
+@contextlib.contextmanager
+def _staged(task, stage):
+    '''Run the task in the staging mapset, if it uses any maps.'''
+    if stage is None or task.scratch:
+        yield
+        return
+    if not stage.wants(task):
+        yield
+        stage.evict(task.outputs + task.removes)
+        return
+    with stage.run(task.inputs, task.outputs, task.removes):
+        yield
+
+
+def _place(event, place):
+    '''Return the database, location and mapset of a location event.
+
+    Values missing from the event are taken from ``place``.
+    '''
+    return (event.gisdbase or place[0], event.location or place[1],
+            event.mapset or place[2])
+
+
+def execute(stream, stdout, stderr, registry=None, profiler=None,
+            scratch=None, stage=None, place=None):
+    registry = registry or TaskRegistry()
+    # The scratch and staging mapsets only exist in the initial location
+    initial = True
     for event in stream:
+        if isinstance(event, LocationEvent) and place is not None:
+            initial = _place(event, place) == place
         if not isinstance(event, TaskEvent):
+            yield event
             continue
-        yield TaskStartEvent(event.ref, event.message)
+        yield TaskStartEvent(event.ref, event.message, task=event)
         if event.status == TaskStatus.SKIP:
             yield TaskSkipEvent(event)
             continue
         elif event.status == TaskStatus.FAIL:
-            raise Error(event)
+            raise Error('Task "{}" cannot be run, {}, in "{}" at "{}"'.format(
+                event.task, event.reason, event.pipeline, event.ref))
         elif event.status == TaskStatus.RUN:
-            function = _load_task(event)
-            with wurlitzer.pipes(stdout=stdout, stderr=stderr):
-                function(**event.params)
+            if event.scratch and not initial:
+                raise Error('Scratch mapset is only available in the initial '
+                            'location, for task "{}", in "{}" at "{}"'.format(
+                                event.task, event.pipeline, event.ref))
+            function = registry.resolve(event)
+            params = dict(event.params)
+            execution = resolve_execution(event.execution)
+            if 'execution' not in params and _accepts(function, 'execution'):
+                params['execution'] = execution
+            if 'changes' not in params and _accepts(function, 'changes'):
+                params['changes'] = event.changes
+            if profiler is not None:
+                function = profiler.wrap(event, function)
+            started = _clock()
+            with _execution_environment(execution), \
+                    _scratch_mapset(event, scratch), \
+                    _staged(event, stage if initial else None), \
+                    wurlitzer.pipes(stdout=stdout, stderr=stderr):
+                function(**params)
+            event.duration = _clock() - started
             yield TaskCompleteEvent(event)
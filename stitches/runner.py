@@ -0,0 +1,508 @@
+# This file is part of Stitches.
+#
+# Stitches is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Stitches is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Stitches. If not, see <https://www.gnu.org/licenses/>.
+
+import collections
+import contextlib
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import traceback
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+try:
+    from io import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import jinja2
+
+from .core import _clock
+from .core import _place
+from .core import _validated
+from .core import Index
+from .core import LocationEvent
+from .core import MultiReporter
+from .core import PlanEvent
+from .core import Platform
+from .core import ProgressReporter
+from .core import Resource
+from .core import SilentReporter
+from .core import State
+from .core import StateSaveEvent
+from .core import TaskCompleteEvent
+from .core import TaskFatalEvent
+from .core import TaskRegistry
+from .core import TaskSkipEvent
+from .core import TaskStartEvent
+from .core import TaskStatus
+from .core import analyse
+from .core import cleanup
+from .core import estimate_durations
+from .core import execute
+from .core import load
+from .session import _grass_binary
+from .session import _grass_install_dir
+from .session import _grass_version
+from .session import SessionPool
+from .session import scratch_mapset
+from .session import staging_mapset
+from .session import session
+
+
+class RunResult(object):
+    '''The outcome of running a pipeline.'''
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        # Where the pipeline was run, once known
+        self.gisdbase = None
+        self.location = None
+        self.mapset = None
+        # Status of each task, by reference, in the order they were started
+        self.statuses = collections.OrderedDict()
+        # Seconds taken by each task that was run
+        self.durations = collections.OrderedDict()
+        # Stack traces of any errors
+        self.errors = []
+        self.duration = None
+        # Output of all tasks
+        self.stdout = ''
+        self.stderr = ''
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __call__(self, event):
+        if isinstance(event, TaskStartEvent):
+            # Tasks that are started, but never completed, have failed
+            self.statuses[event.ref] = TaskStatus.FAIL
+        elif isinstance(event, TaskSkipEvent):
+            self.statuses[event.task.ref] = TaskStatus.SKIP
+        elif isinstance(event, TaskCompleteEvent):
+            self.statuses[event.task.ref] = TaskStatus.RUN
+            self.durations[event.task.ref] = event.task.duration
+        elif isinstance(event, TaskFatalEvent):
+            self.errors.append(event.traceback)
+
+
+def _resource_ref(name):
+    '''Return a resource reference, treating anything else as a file path.'''
+    types = (Resource.FILE, Resource.DIR, Resource.VECTOR,
+             Resource.RASTER) + Resource.DATASETS
+    if name.split('/', 1)[0] in types:
+        return name
+    return '{}/{}'.format(Resource.FILE, name)
+
+
+@contextlib.contextmanager
+def _scratch(tasks, gisdbase, location, mapset, directory):
+    if not any(task.scratch for task in tasks):
+        yield None
+        return
+    with scratch_mapset(gisdbase, location, mapset=mapset,
+                        directory=directory) as name:
+        yield name
+
+
+@contextlib.contextmanager
+def _stage(gisdbase, location, mapset, directory):
+    if directory is None:
+        yield None
+        return
+    with staging_mapset(gisdbase, location, mapset=mapset,
+                        directory=directory) as stage:
+        yield stage
+
+
+def _state_path(gisdbase, location, mapset):
+    return os.path.join(gisdbase, location, mapset or 'PERMANENT',
+                        'stitches.state.json')
+
+
+class _LocationHistory(MutableMapping):
+    '''The history of a pipeline, kept in the state of each of its locations.
+
+    Tasks are looked up, and recorded, in the state of the current location.
+    The state of other locations is loaded, and locked, when the pipeline
+    first switches to them. History removed once no longer needed is removed
+    from every state.
+    '''
+
+    def __init__(self, runner, state):
+        self.runner = runner
+        self.states = collections.OrderedDict([(state.path, state)])
+        self.current = state
+        self._locks = []
+
+    def switch(self, gisdbase, location, mapset):
+        path = _state_path(gisdbase, location, mapset)
+        if path not in self.states:
+            # pylint: disable=protected-access
+            state = self.runner._state(path, self.current.namespace)
+            lock = state.lock()
+            lock.__enter__()
+            self._locks.append(lock)
+            self.states[path] = state
+        self.current = self.states[path]
+
+    def close(self):
+        for lock in reversed(self._locks):
+            lock.__exit__(None, None, None)
+        del self._locks[:]
+
+    def __getitem__(self, key):
+        if key in self.current.history:
+            return self.current.history[key]
+        for state in self.states.values():
+            if key in state.history:
+                return state.history[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.current.history[key] = value
+
+    def __delitem__(self, key):
+        states = [s for s in self.states.values() if key in s.history]
+        if not states:
+            raise KeyError(key)
+        for state in states:
+            del state.history[key]
+
+    def __iter__(self):
+        seen = set()
+        for state in self.states.values():
+            for key in state.history:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(set(itertools.chain.from_iterable(
+            s.history for s in self.states.values())))
+
+    def __contains__(self, key):
+        return key in self.current.history
+
+    def get(self, key, default=None):
+        return self.current.history.get(key, default)
+
+    def setdefault(self, key, default=None):
+        return self.current.history.setdefault(key, default)
+
+
+def _save(state, reporter):
+    started = _clock()
+    state.save()
+    reporter(StateSaveEvent(_clock() - started))
+
+
+class Runner(object):
+    '''Runs many pipelines in a single process.
+
+    Task references, pipeline templates, the state of each pipeline and the
+    location of GRASS GIS are cached between runs. The maps and region of
+    each mapset, listed by the platform, are kept until the files of the
+    mapset change. A GRASS GIS session is still started for each run.
+    '''
+
+    def __init__(self, platform=None, registry=None):
+        self.platform = platform or Platform()
+        self.registry = registry or TaskRegistry()
+        self._environments = {}
+        self._states = {}
+        self._grass = None
+
+    def _environment(self, directory):
+        '''Return the template environment of pipelines in a directory.'''
+        if directory not in self._environments:
+            env = jinja2.Environment(loader=jinja2.FileSystemLoader(directory))
+            env.filters['basename'] = os.path.basename
+            env.filters['dirname'] = os.path.dirname
+            self._environments[directory] = env
+        return self._environments[directory]
+
+    def _state(self, path, namespace):
+        '''Return the state of a pipeline, unless changed by another process.'''
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        (state, seen) = self._states.get((path, namespace), (None, None))
+        if state is None or seen != mtime:
+            state = State.load(path, namespace=namespace)
+        self._states[(path, namespace)] = (state, mtime)
+        return state
+
+    def _seen(self, state):
+        '''Remember the state as written by this runner.'''
+        mtime = None
+        if os.path.exists(state.path):
+            mtime = os.path.getmtime(state.path)
+        self._states[(state.path, state.namespace)] = (state, mtime)
+
+    def _grass_install(self):
+        '''Return the GRASS GIS binary and install directory.'''
+        if self._grass is None:
+            grassbin = _grass_binary()
+            self._grass = (grassbin, _grass_install_dir(grassbin))
+        return self._grass
+
+    def _session(self, gisdbase, location, mapset, skip):
+        if skip:
+            return session(gisdbase, location, skip=skip)
+        (grassbin, gisbase) = self._grass_install()
+        return session(gisdbase, location, mapset=mapset, grassbin=grassbin,
+                       gisbase=gisbase)
+
+    def _fingerprint(self):
+        '''Return the fingerprint of the code run by tasks.'''
+        if self.registry.grass_version is None:
+            if os.environ.get('GISRC'):
+                from ._grass import gcore
+                version = gcore.version()['version']
+            else:
+                version = _grass_version(self._grass_install()[0])
+            self.registry.grass_version = version
+        return self.registry.fingerprint
+
+    def _open(self, pipeline, variables, gisdbase, location, mapset):
+        # pylint: disable=too-many-arguments
+        '''Return the template environment, root options and location.'''
+        path = os.path.abspath(pipeline)
+        jinja_env = self._environment(os.path.dirname(path))
+        options = {
+            'pipeline': os.path.basename(path),
+            'params': {
+                'vars': variables or {},
+                'gisdbase': gisdbase,
+                'location': location,
+                'mapset': mapset,
+            }
+        }
+
+        # Check the first item in the stream for a location event
+        stream = load(jinja_env, options)
+        initial = next(stream, None)
+        if isinstance(initial, LocationEvent):
+            gisdbase = initial.gisdbase
+            location = initial.location
+            mapset = initial.mapset
+        else:
+            stream = itertools.chain(iter([initial]), stream)
+
+        if os.environ.get('GISRC') and not (gisdbase and location and mapset):
+            from ._grass import gcore
+            env = gcore.gisenv()
+            gisdbase = gisdbase or env['GISDBASE']
+            location = location or env['LOCATION_NAME']
+            mapset = mapset or env['MAPSET']
+
+        state = self._state(_state_path(gisdbase, location, mapset), path)
+        return (jinja_env, options, stream, initial, state,
+                (gisdbase, location, mapset))
+
+    def affected(self, pipeline, names, vars=None, gisdbase=None,
+                 location=None, mapset=None):
+        # pylint: disable=redefined-builtin
+        '''Return the tasks downstream of resources or files.
+
+        Each task is paired with its duration, estimated from previous runs.
+        '''
+        (jinja_env, options, _, _, state, _) = self._open(
+            pipeline, vars, gisdbase, location, mapset)
+        affected = Index.build(load(jinja_env, options)).downstream(
+            [_resource_ref(name) for name in names])
+        estimates = estimate_durations(affected, state.history)
+        return [(task, estimates[task.ref]) for task in affected]
+
+    def run(self, pipeline, vars=None, gisdbase=None, location=None,
+            mapset=None, force=False, skip=None, only=None, invalidate=None,
+            reporter=None, progress=False, profiler=None, scratch=None,
+            track_code=False, stage=None):
+        # pylint: disable=redefined-builtin,too-many-locals
+        '''Run a pipeline, returning a ``RunResult``.
+
+        Errors are recorded in the result, rather than raised. With
+        ``track_code``, tasks are also run when the source of their python
+        module, or the version of GRASS GIS they use, has changed. With
+        ``stage``, a directory on local disk, tasks using maps are run in a
+        mapset there, with copies of their inputs.
+
+        Sub-pipelines in other locations, or mapsets, are run in a session of
+        their own, kept for the whole run, with the history of their tasks in
+        the state of that mapset.
+        '''
+        result = RunResult(pipeline)
+        reporter = MultiReporter(result, reporter or SilentReporter())
+        (stdout, stderr) = (StringIO(), StringIO())
+        started = _clock()
+        # Maps and the region are checked against their files, other queries
+        # may have been changed since the last run
+        self.platform.update()
+
+        try:
+            (jinja_env, options, stream, initial, state, place) = self._open(
+                pipeline, vars, gisdbase, location, mapset)
+            (gisdbase, location, mapset) = place
+            (result.gisdbase, result.location, result.mapset) = place
+            history = _LocationHistory(self, state)
+            if progress:
+                reporter = MultiReporter(
+                    ProgressReporter(history, force=force), reporter)
+            if isinstance(initial, LocationEvent):
+                reporter(initial)
+
+            # Resolve and index all tasks up front, in a single pass over the
+            # pipeline, to fail before doing any work. The pipeline is loaded
+            # again to be run, so generated pipelines must be finite.
+            index = Index.build(_validated(load(jinja_env, options),
+                                           self.registry))
+            reporter(PlanEvent(index.tasks))
+
+            # Analyse the stream of events with the previous state
+            invalidated = index.downstream(
+                [_resource_ref(name) for name in invalidate or []])
+            stream = analyse(stream, self.platform, history,
+                             force=force, skip=skip, only=only, index=index,
+                             invalidated=[task.ref for task in invalidated],
+                             fingerprint=(self._fingerprint() if track_code
+                                          else None))
+
+            os.environ['GRASS_MESSAGE_FORMAT'] = 'plain'
+            session_exists = bool(os.environ.get('GISRC'))
+            with self._session(gisdbase, location, mapset, session_exists):
+                with state.lock(), \
+                        _scratch(index.tasks, gisdbase, location, mapset,
+                                 scratch) as scratch_name, \
+                        _stage(gisdbase, location, mapset, stage) as staged:
+                    stream = execute(stream, stdout, stderr,
+                                     registry=self.registry,
+                                     profiler=profiler, scratch=scratch_name,
+                                     stage=staged,
+                                     place=(gisdbase, location, mapset))
+                    sessions = SessionPool(
+                        gisdbase, location, mapset,
+                        grassbin=self._grass[0] if self._grass else None)
+                    try:
+                        for event in cleanup(stream, index, self.platform,
+                                             history, scratch=scratch_name):
+                            if isinstance(event, TaskCompleteEvent):
+                                self.platform.update(event.task.outputs,
+                                                     event.task.removes)
+                                _save(history.current, reporter)
+                            elif isinstance(event, LocationEvent):
+                                place = _place(event, (gisdbase, location,
+                                                       mapset))
+                                if sessions.switch(*place):
+                                    self.platform.update()
+                                    history.switch(*place)
+                            reporter(event)
+                        for state_ in history.states.values():
+                            _save(state_, reporter)
+                            self._seen(state_)
+                    finally:
+                        sessions.close()
+                        history.close()
+        except Exception:  # pylint: disable=broad-except
+            reporter(TaskFatalEvent(traceback.format_exc()))
+
+        result.duration = _clock() - started
+        result.stdout = stdout.getvalue()
+        result.stderr = stderr.getvalue()
+        stdout.close()
+        stderr.close()
+        return result
+
+
+def run(pipeline, runner=None, **kwargs):
+    '''Run a pipeline, returning a ``RunResult``.
+
+    A ``Runner`` may be given to reuse its caches across many runs. All other
+    keyword arguments are passed to ``Runner.run``.
+    '''
+    runner = runner or Runner()
+    return runner.run(pipeline, **kwargs)
+
+
+def read_instances(path):
+    '''Read the variables of each instance of a sweep.
+
+    Files ending in ``.csv`` have a header row naming the variables, others
+    have a JSON object on each line.
+    '''
+    with open(path, 'r') as fp:
+        if path.endswith('.csv'):
+            return [dict(row) for row in csv.DictReader(fp)]
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+# Runner of each worker process of a sweep
+_RUNNER = None
+
+
+def _sweep_instance(job):
+    global _RUNNER  # pylint: disable=global-statement
+    (index, pipeline, options) = job
+    if _RUNNER is None:
+        # Each instance has its own session, in its own mapset
+        os.environ.pop('GISRC', None)
+        _RUNNER = Runner()
+    return (index, _RUNNER.run(pipeline, **options))
+
+
+def sweep(pipeline, instances, vars=None, mapset='sweep_{index}',
+          workers=None, **kwargs):
+    # pylint: disable=redefined-builtin
+    '''Run a pipeline once for each set of variables, in a process pool.
+
+    Each instance is run in its own mapset, named by formatting ``mapset``
+    with the instance's variables and its ``index``, and so keeps its own
+    state. Maps in the ``PERMANENT`` mapset are shared by all instances. The
+    index and ``RunResult`` of each instance are yielded as they finish.
+
+    Keyword Args:
+        instances (list): Variables of each instance, eg. from
+            ``read_instances``
+        vars (dict): Variables shared by all instances
+        mapset (str): Format of the mapset name of each instance
+        workers (int): Number of processes, defaults to the number of cores
+        **kwargs: Keyword arguments passed to ``Runner.run``
+
+    '''
+    if os.environ.get('GISRC'):
+        from ._grass import gcore
+        env = gcore.gisenv()
+        kwargs['gisdbase'] = kwargs.get('gisdbase') or env['GISDBASE']
+        kwargs['location'] = kwargs.get('location') or env['LOCATION_NAME']
+
+    jobs = []
+    for (index, instance) in enumerate(instances):
+        variables = dict(vars or {})
+        variables.update(instance)
+        names = dict(variables, index=index)
+        options = dict(kwargs, vars=variables, mapset=mapset.format(**names))
+        jobs.append((index, pipeline, options))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for finished in pool.imap_unordered(_sweep_instance, jobs):
+            yield finished
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
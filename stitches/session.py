@@ -14,9 +14,13 @@
 # along with Stitches. If not, see <https://www.gnu.org/licenses/>.
 
 import contextlib
+import hashlib
+import json
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
 
 
 def _process(cmd):
@@ -55,9 +59,85 @@ def _grass_install_dir(grassbin):
     return out.strip()
 
 
+def _grass_version(grassbin):
+    code, out, err = _process([grassbin, '--config', 'version'])
+    if code != 0:
+        raise RuntimeError(err)
+    return out.strip()
+
+
+def _default_template_directory():
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'stitches', 'locations')
+
+
+def _create_location(grassbin, lpath, c=None, templates=None):
+    '''Create a location by copying a template, created once per projection.
+
+    A location created at the same time by another process is left as is.
+    '''
+    georef = c or ''
+    key = [grassbin, georef]
+    if os.path.exists(georef):
+        key.extend([os.path.abspath(georef), os.path.getmtime(georef)])
+    name = hashlib.md5(json.dumps(key).encode('utf-8')).hexdigest()
+    templates = templates or _default_template_directory()
+    template = os.path.join(templates, name)
+
+    if not os.path.exists(template):
+        if not os.path.isdir(templates):
+            os.makedirs(templates)
+        staging = tempfile.mkdtemp(prefix='.stitches_', dir=templates)
+        try:
+            path = os.path.join(staging, 'location')
+            code, _, err = _process([grassbin, '-c', georef, '-e', path])
+            if code != 0:
+                raise RuntimeError(err)
+            try:
+                os.rename(path, template)
+            except OSError:
+                # Created at the same time by another process
+                if not os.path.exists(template):
+                    raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    # Copied alongside, then moved into place, as other processes, such as
+    # the workers of a sweep, may be creating the same location
+    parent = os.path.dirname(os.path.abspath(lpath))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    staging = tempfile.mkdtemp(prefix='.stitches_', dir=parent)
+    try:
+        path = os.path.join(staging, 'location')
+        shutil.copytree(template, path, symlinks=True)
+        try:
+            os.rename(path, lpath)
+        except OSError:
+            if not os.path.exists(lpath):
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def _create_mapset(lpath, mapset):
+    '''Create an empty mapset, with the default region of the location.'''
+    mpath = os.path.join(lpath, mapset)
+    os.mkdir(mpath)
+    shutil.copy(os.path.join(lpath, 'PERMANENT', 'DEFAULT_WIND'),
+                os.path.join(mpath, 'WIND'))
+
+
 @contextlib.contextmanager
 def session(gisdbase, location, mapset=None, c=None, version=None,
-            grassbin=None, gisbase=None, skip=None):
+            grassbin=None, gisbase=None, skip=None, templates=None):
+    '''Start a GRASS GIS session, creating the location and mapset if needed.
+
+    New locations are copied from a template, created with GRASS GIS once for
+    each projection and kept in the ``templates`` directory. New mapsets are
+    created directly.
+    '''
     if skip:
         yield
         return
@@ -69,11 +149,10 @@ def session(gisdbase, location, mapset=None, c=None, version=None,
     lpath = os.path.join(gisdbase, location)
     mpath = os.path.join(lpath, mapset)
 
-    for path in [lpath, mpath]:
-        if not os.path.exists(path):
-            code, _, err = _process([grassbin, '-c', c or '', '-e', path])
-            if code != 0:
-                raise RuntimeError(err)
+    if not os.path.exists(lpath):
+        _create_location(grassbin, lpath, c=c, templates=templates)
+    if not os.path.exists(mpath):
+        _create_mapset(lpath, mapset)
 
     os.environ['GISBASE'] = gisbase
     grass_python_path = os.path.join(gisbase, 'etc', 'python')
@@ -87,3 +166,246 @@ def session(gisdbase, location, mapset=None, c=None, version=None,
         os.remove(os.environ['GISRC'])
         os.environ.pop('GISRC')
         os.environ.pop('GIS_LOCK')
+
+
+class SessionPool(object):
+    '''GRASS GIS sessions for every location of a pipeline, in one process.
+
+    GRASS GIS is set up once, for the session that is current when the pool is
+    created. Other locations and mapsets are given their own ``GISRC`` file
+    when first used, and switching between them only changes the ``GISRC``
+    environment variable.
+    '''
+
+    def __init__(self, gisdbase, location, mapset=None, grassbin=None,
+                 templates=None):
+        self.grassbin = grassbin
+        self.templates = templates
+        self.initial = (gisdbase, location, mapset or 'PERMANENT')
+        self.current = self.initial
+        self.files = {self.initial: os.environ['GISRC']}
+
+    def _create(self, gisdbase, location, mapset):
+        lpath = os.path.join(gisdbase, location)
+        if not os.path.exists(lpath):
+            self.grassbin = self.grassbin or _grass_binary()
+            _create_location(self.grassbin, lpath, templates=self.templates)
+        if not os.path.exists(os.path.join(lpath, mapset)):
+            _create_mapset(lpath, mapset)
+        (fd, path) = tempfile.mkstemp(prefix='stitches_gisrc_')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('GISDBASE: {}\nLOCATION_NAME: {}\nMAPSET: {}\n'
+                     'GUI: text\n'.format(gisdbase, location, mapset))
+        return path
+
+    def switch(self, gisdbase, location, mapset=None):
+        '''Make a location current, returning true if it was not already.'''
+        key = (gisdbase, location, mapset or 'PERMANENT')
+        if key == self.current:
+            return False
+        if key not in self.files:
+            self.files[key] = self._create(*key)
+        os.environ['GISRC'] = self.files[key]
+        self.current = key
+        return True
+
+    def close(self):
+        '''Return to the initial session, removing all other sessions.'''
+        self.switch(*self.initial)
+        for (key, path) in self.files.items():
+            if key != self.initial:
+                os.remove(path)
+        self.files = {self.initial: self.files[self.initial]}
+
+
+def _default_scratch_directory():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return None
+
+
+@contextlib.contextmanager
+def scratch_mapset(gisdbase, location, mapset=None, directory=None,
+                   prefix='stitches_scratch_'):
+    '''Create a temporary mapset, for the duration of a session.
+
+    The mapset is created in a fast local directory (tmpfs by default), linked
+    into the location and added to the search path of the current mapset.
+    '''
+    from ._grass import gcore
+    mapset = mapset or 'PERMANENT'
+    directory = directory or _default_scratch_directory()
+    lpath = os.path.join(gisdbase, location)
+
+    root = tempfile.mkdtemp(prefix=prefix, dir=directory)
+    name = os.path.basename(root)
+    link = os.path.join(lpath, name)
+    os.symlink(root, link)
+    try:
+        shutil.copy(os.path.join(lpath, mapset, 'WIND'),
+                    os.path.join(root, 'WIND'))
+        with open(os.path.join(root, 'SEARCH_PATH'), 'w') as fp:
+            search_path = [name, mapset]
+            if mapset != 'PERMANENT':
+                search_path.append('PERMANENT')
+            fp.write('\n'.join(search_path) + '\n')
+        gcore.run_command('g.mapsets', operation='add', mapset=name,
+                          quiet=True)
+        try:
+            yield name
+        finally:
+            gcore.run_command('g.mapsets', operation='remove', mapset=name,
+                              quiet=True)
+    finally:
+        os.remove(link)
+        shutil.rmtree(root, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def use_mapset(mapset):
+    '''Switch the current mapset, keeping the region of the previous one.'''
+    from ._grass import gcore
+    env = gcore.gisenv()
+    lpath = os.path.join(env['GISDBASE'], env['LOCATION_NAME'])
+    shutil.copy(os.path.join(lpath, env['MAPSET'], 'WIND'),
+                os.path.join(lpath, mapset, 'WIND'))
+    gcore.run_command('g.gisenv', set='MAPSET={}'.format(mapset))
+    try:
+        yield
+    finally:
+        gcore.run_command('g.gisenv', set='MAPSET={}'.format(env['MAPSET']))
+
+
+# Elements of a mapset holding the files of raster maps
+_RASTER_ELEMENTS = ('cell', 'cellhd', 'cell_misc', 'fcell', 'cats', 'colr',
+                    'hist')
+# Elements holding colour tables and quantisation rules, kept by a mapset for
+# raster maps in other mapsets, in a directory for each of those mapsets
+_RASTER_SECONDARY_ELEMENTS = ('colr2', 'quant2')
+
+
+def _raster_paths(mpath, name):
+    '''Return the paths of the files of a raster map, within a mapset.'''
+    paths = [os.path.join(element, name) for element in _RASTER_ELEMENTS]
+    for element in _RASTER_SECONDARY_ELEMENTS:
+        directory = os.path.join(mpath, element)
+        if os.path.isdir(directory):
+            paths.extend(os.path.join(element, mapset, name)
+                         for mapset in sorted(os.listdir(directory)))
+    return [path for path in paths
+            if os.path.exists(os.path.join(mpath, path))]
+
+
+def _copy_raster(source, target, name):
+    '''Copy the files of a raster map between mapset directories.'''
+    _remove_raster(target, name)
+    for path in _raster_paths(source, name):
+        if os.path.isdir(os.path.join(source, path)):
+            shutil.copytree(os.path.join(source, path),
+                            os.path.join(target, path))
+        else:
+            directory = os.path.dirname(os.path.join(target, path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            shutil.copy2(os.path.join(source, path),
+                         os.path.join(target, path))
+
+
+def _remove_raster(mpath, name):
+    '''Remove the files of a raster map from a mapset directory.'''
+    for path in _raster_paths(mpath, name):
+        if os.path.isdir(os.path.join(mpath, path)):
+            shutil.rmtree(os.path.join(mpath, path))
+        else:
+            os.remove(os.path.join(mpath, path))
+
+
+class Stage(object):
+    '''Copies of maps in a mapset on local disk, for tasks to be run there.
+
+    Raster maps are copied file by file. Vector maps, with their attributes,
+    are copied with ``g.copy``. Copies are kept between tasks until the map is
+    replaced or removed outside of the stage.
+    '''
+
+    def __init__(self, gisdbase, location, mapset, name):
+        self.lpath = os.path.join(gisdbase, location)
+        self.mapset = mapset
+        self.name = name
+        # Maps with an up to date copy in the stage, as (type, name)
+        self.cached = set()
+
+    def _grass_maps(self, resources):
+        # Maps qualified with another mapset are read from where they are
+        return [(r.type, r.name) for r in resources
+                if r.type in ('raster', 'vector') and r.mapset is None]
+
+    @contextlib.contextmanager
+    def run(self, inputs, outputs, removes=()):
+        '''Run in the stage, with copies of inputs and copying back outputs.'''
+        from ._grass import gcore
+        with use_mapset(self.name):
+            for (type_, name) in self._grass_maps(inputs):
+                if (type_, name) in self.cached:
+                    continue
+                found = gcore.find_file(name, element=(
+                    'cellhd' if type_ == 'raster' else 'vector'))
+                if not found['file']:
+                    continue
+                if type_ == 'raster':
+                    _copy_raster(os.path.join(self.lpath, found['mapset']),
+                                 os.path.join(self.lpath, self.name), name)
+                else:
+                    gcore.run_command('g.copy', vector='{},{}'.format(
+                        found['fullname'], name), overwrite=True, quiet=True)
+                self.cached.add((type_, name))
+            yield
+            shutil.copy(os.path.join(self.lpath, self.name, 'WIND'),
+                        os.path.join(self.lpath, self.mapset, 'WIND'))
+
+        # Copy all outputs back at once, to the mapset of the session
+        for (type_, name) in self._grass_maps(outputs):
+            if type_ == 'raster':
+                _copy_raster(os.path.join(self.lpath, self.name),
+                             os.path.join(self.lpath, self.mapset), name)
+            else:
+                vector = '{name}@{stage},{name}'.format(name=name,
+                                                         stage=self.name)
+                gcore.run_command('g.copy', vector=vector, overwrite=True,
+                                  quiet=True)
+            self.cached.add((type_, name))
+        self.evict(removes, home=True)
+
+    def evict(self, resources, home=False):
+        '''Forget copies of maps replaced or removed outside of the stage.
+
+        With ``home``, the maps are also removed from the mapset of the
+        session, for maps removed by a task run in the stage.
+        '''
+        from ._grass import gcore
+        maps = self._grass_maps(resources)
+        if home:
+            for (type_, name) in maps:
+                gcore.run_command('g.remove', flags='f', type=type_,
+                                  name=name, quiet=True)
+        maps = [m for m in maps if m in self.cached]
+        if not maps:
+            return
+        self.cached.difference_update(maps)
+        with use_mapset(self.name):
+            for (type_, name) in maps:
+                gcore.run_command('g.remove', flags='f', type=type_,
+                                  name=name, quiet=True)
+
+    def wants(self, task):
+        '''Returns true if a task uses, or creates, any maps.'''
+        return bool(self._grass_maps(task.inputs + task.outputs))
+
+
+@contextlib.contextmanager
+def staging_mapset(gisdbase, location, mapset=None, directory=None):
+    '''Create a ``Stage`` in a mapset on local disk, for a session.'''
+    with scratch_mapset(gisdbase, location, mapset=mapset,
+                        directory=directory,
+                        prefix='stitches_stage_') as name:
+        yield Stage(gisdbase, location, mapset or 'PERMANENT', name)
@@ -13,28 +13,258 @@
 # You should have received a copy of the GNU General Public License
 # along with Stitches. If not, see <https://www.gnu.org/licenses/>.
 
+import collections
+import multiprocessing
+import os
 import subprocess
 
 
-def grass(module=None, **kwargs):
+def grass(module=None, execution=None, **kwargs):
     '''Run a GRASS GIS command.
 
     Please refer to the relevant version of `documentation`_ for
     ``grass.pygrass.modules.Module`` for more information.
 
+    The ``nprocs`` and ``memory`` options of the task's execution profile are
+    passed to modules that support them, unless given explicitly.
+
     .. _documentation: https://grass.osgeo.org/grass76/manuals/libpython/pygrass_modules.html
 
     Keyword Args:
         module (str): GRASS GIS command name
+        execution (dict): Resolved execution profile, provided by stitches
         **kwargs: Keyword arguments passed to ``grass.pygrass.modules.Module``
 
     '''
     from ._grass import Module
     assert module
     instance = Module(module)
+    for option in ('nprocs', 'memory'):
+        value = (execution or {}).get(option)
+        if value is not None and option in instance.inputs:
+            kwargs.setdefault(option, value)
     instance(**kwargs)
 
 
+def _batch_module(invocation, **special):
+    from ._grass import Module
+    params = dict(invocation)
+    module = params.pop('module', None)
+    assert module
+    params.update(special)
+    return Module(module, run_=False, stderr_=subprocess.PIPE, **params)
+
+
+def grass_batch(modules=None, workers=None, execution=None):
+    '''Run many GRASS GIS commands in parallel, as a single task.
+
+    Commands are run with ``grass.pygrass.modules.ParallelModuleQueue``.
+    Commands given as a ``sequence`` are run one after the other, in a single
+    worker, with ``grass.pygrass.modules.MultiModule``. All commands are run
+    before reporting any failures.
+
+    Keyword Args:
+        modules (list): Tables of keyword arguments, as for the ``grass``
+            task, or tables with a ``sequence`` of such tables
+        workers (int): Maximum number of commands to run at once, defaults to
+            ``nprocs`` of the execution profile or the number of usable cores
+        execution (dict): Resolved execution profile, provided by stitches
+
+    '''
+    from ._grass import MultiModule
+    from ._grass import ParallelModuleQueue
+    from .core import _cpu_count
+    assert modules
+    workers = (workers or (execution or {}).get('nprocs') or _cpu_count())
+
+    queue = ParallelModuleQueue(nprocs=workers)
+    submitted = []
+    for invocation in modules:
+        if 'sequence' in invocation:
+            module = MultiModule(
+                module_list=[_batch_module(i)
+                             for i in invocation['sequence']],
+                sync=False)
+        else:
+            module = _batch_module(invocation, finish_=False, check_=False)
+        submitted.append(module)
+        queue.put(module)
+    queue.wait()
+
+    failures = []
+    for module in submitted:
+        # Sequences are run in another process, and stop on the first error
+        for instance in getattr(module, 'module_list', [module]):
+            code = getattr(instance, 'returncode', None)
+            if code:
+                stderr = instance.outputs['stderr'].value or ''
+                failures.append('{} (exit code {}): {}'.format(
+                    instance.get_bash(), code, stderr.strip()))
+    if failures:
+        raise RuntimeError('{} of {} commands failed\n{}'.format(
+            len(failures), len(submitted), '\n'.join(failures)))
+
+
+_LINK_MODULES = {
+    'raster': ('r.external', 'r.import'),
+    'vector': ('v.external', 'v.import'),
+}
+
+
+def grass_link(input=None, output=None, type='raster', **kwargs):
+    # pylint: disable=redefined-builtin
+    '''Link a file into the mapset, without copying its data.
+
+    The file is linked with ``r.external`` or ``v.external``. Files that can
+    not be linked, such as those in a format unsupported by GDAL/OGR or in a
+    different projection, are imported with ``r.import`` or ``v.import``.
+
+    Changes to the file are only seen by stitches when it is also listed as a
+    ``file/`` input of the task, which then links the map again and runs the
+    tasks that use it.
+
+    Keyword Args:
+        input (str): Path of the file
+        output (str): Name of the map
+        type (str): Either ``raster`` or ``vector``
+        **kwargs: Keyword arguments passed to both modules, eg. ``band`` or
+            ``layer``
+
+    '''
+    from ._grass import Module
+    assert input and output
+    assert type in _LINK_MODULES
+    (link, fallback) = _LINK_MODULES[type]
+    # Links are followed from the current directory of later GRASS sessions
+    kwargs.update(input=os.path.abspath(input), output=output)
+    kwargs.setdefault('overwrite', True)
+
+    instance = Module(link, check_=False, stderr_=subprocess.PIPE, **kwargs)
+    if instance.returncode:
+        Module(fallback, **kwargs)
+
+
+def _blocks(rows, size, halo):
+    '''Yield the rows of each block, and of the block with its halo.'''
+    for start in range(0, rows, size):
+        stop = min(start + size, rows)
+        yield (start, stop, max(start - halo, 0), min(stop + halo, rows))
+
+
+# Opened in each worker process of ``grass_blocks``
+_BLOCK_WORKER = {}
+
+
+def _block_init(function, inputs):
+    from ._grass import RasterRow
+    from .core import _import_callable
+    if not callable(function):
+        function = _import_callable(function)
+    rasters = []
+    for name in inputs:
+        raster = RasterRow(name)
+        raster.open('r')
+        rasters.append(raster)
+    _BLOCK_WORKER.update(function=function, inputs=rasters)
+
+
+def _block_run(start, stop, low, high):
+    import numpy
+    arrays = [numpy.vstack([raster.get_row(row) for row in range(low, high)])
+              for raster in _BLOCK_WORKER['inputs']]
+    result = numpy.asarray(_BLOCK_WORKER['function'](*arrays))
+    if result.shape[0] != high - low:
+        raise RuntimeError('Expected {} rows from block {}-{}, got {}'.format(
+            high - low, low, high, result.shape[0]))
+    return result[start - low:stop - low]
+
+
+def _block_results(pool, blocks, queued):
+    '''Yield the result of each block in order, with a few queued ahead.'''
+    pending = collections.deque()
+    for block in blocks:
+        pending.append(pool.apply_async(_block_run, block))
+        if len(pending) >= queued:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _block_open(output, block, mtype):
+    '''Open the output, of the type of the first block unless given.'''
+    from ._grass import RasterRow
+    if mtype is None and block.dtype.kind == 'f':
+        mtype = 'FCELL' if block.dtype.itemsize == 4 else 'DCELL'
+    raster = RasterRow(output)
+    raster.open('w', mtype=mtype or 'CELL', overwrite=True)
+    return raster
+
+
+def _block_write(raster, block):
+    '''Write the rows of a block.'''
+    from ._grass import Buffer
+    for values in block:
+        row = Buffer(values.shape, mtype=raster.mtype)
+        row[:] = values
+        raster.put_row(row)
+
+
+def grass_blocks(function=None, inputs=None, output=None, rows=256, halo=0,
+                 mtype=None, workers=None, execution=None):
+    # pylint: disable=too-many-arguments
+    '''Apply a NumPy function to raster maps, a block of rows at a time.
+
+    The function is called with a 2D array of the rows of each input, within
+    the current region, and returns an array of the same shape. Blocks are
+    read with ``grass.pygrass.raster.RasterRow`` and processed in a pool of
+    processes, then written to the output in order, so memory is bounded by
+    the size of a block rather than the size of the maps. Null cells of
+    floating point maps are ``nan``. The output is removed if any block fails.
+
+    Keyword Args:
+        function (str): Reference to a python function eg.
+            ``package.module:function``
+        inputs (list): Names of the input raster maps
+        output (str): Name of the output raster map
+        rows (int): Number of rows in each block
+        halo (int): Number of rows read either side of each block, for
+            functions of neighbouring cells, dropped from the result
+        mtype (str): Type of the output, ``CELL``, ``FCELL`` or ``DCELL``,
+            defaults to the type of the array returned by the function
+        workers (int): Number of processes, defaults to ``nprocs`` of the
+            execution profile or the number of usable cores
+        execution (dict): Resolved execution profile, provided by stitches
+
+    '''
+    from ._grass import Region
+    from ._grass import gcore
+    from .core import _cpu_count
+    assert function and inputs and output
+    workers = (workers or (execution or {}).get('nprocs') or _cpu_count())
+
+    pool = multiprocessing.Pool(workers, initializer=_block_init,
+                                initargs=(function, inputs))
+    raster = None
+    try:
+        # Only a few blocks are queued ahead of the one being written
+        blocks = _blocks(Region().rows, rows, halo)
+        for block in _block_results(pool, blocks, workers * 2):
+            if raster is None:
+                raster = _block_open(output, block, mtype)
+            _block_write(raster, block)
+    except BaseException:
+        # Never leave a partially written output behind
+        if raster is not None:
+            raster.close()
+            gcore.run_command('g.remove', flags='f', quiet=True,
+                              type='raster', name=output)
+        raise
+    finally:
+        pool.terminate()
+    if raster is not None:
+        raster.close()
+
+
 def script(cmd=None):
     '''Run an arbitrary shell command.
 
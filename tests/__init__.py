@@ -15,3 +15,22 @@
 
 def dummy_task(**_):
     pass
+
+
+def tile_pipeline(prefix='tile'):
+    '''An endless pipeline of tiles, for testing lazy expansion.'''
+    i = 0
+    while True:
+        yield {
+            'task': 'tests:dummy_task',
+            'inputs': ['file/{}_{}.tif'.format(prefix, i)],
+            'outputs': ['raster/{}_{}'.format(prefix, i)],
+        }
+        i += 1
+
+
+def smooth_rows(dem):
+    '''Average each cell with the cells above and below it.'''
+    import numpy
+    padded = numpy.pad(dem, ((1, 1), (0, 0)), mode='edge')
+    return (padded[:-2] + padded[1:-1] + padded[2:]) / 3.0
@@ -174,6 +174,51 @@ def test_tasks_composite_pipeline(env):
         assert maps[0].decode('utf-8') == 'mypoint'
 
 
+def test_pipeline_other_mapset(env):
+    '''Sub-pipelines run in their own mapset, with their own state.'''
+    other = '''
+    [[tasks]]
+    task = 'grass'
+    outputs = ['vector/mypoint']
+    params = {module='v.import', input='tests/point.geojson', output='mypoint'}
+    '''
+
+    config = '''
+    location = 'foobar'
+
+    [[tasks]]
+    task = 'grass'
+    params = {module='g.proj', c=true, proj4='+proj=utm +zone=33 +datum=WGS84'}
+
+    [[tasks]]
+    pipeline = '{{ other }}'
+    params = {mapset='other'}
+
+    [[tasks]]
+    task = 'grass'
+    inputs = ['vector/mypoint@other']
+    outputs = ['vector/copied']
+    params = {module='g.copy', vector='mypoint@other,copied'}
+    '''
+
+    fopts = dict(mode='w', dir=env.root, prefix='config_', suffix='.toml')
+    with tempfile.NamedTemporaryFile(**fopts) as fp:
+        fp.write(other)
+        fp.flush()
+        returncode, _, _ = env.run([
+            '--vars',
+            'other={}'.format(os.path.basename(fp.name))
+        ], config)
+    assert returncode == 0
+    lpath = os.path.join(env.gisdbase, 'foobar')
+    assert os.path.exists(os.path.join(lpath, 'other', 'stitches.state.json'))
+    with session(env.gisdbase, 'foobar'):
+        from stitches._grass import gcore
+        maps = gcore.read_command(
+            'g.list', type='vector', mapset='.').splitlines()
+        assert [m.decode('utf-8') for m in maps] == ['copied']
+
+
 def test_tasks_composite_pipeline_output(env):
     '''Composing pipelines.'''
     other = '''
@@ -323,3 +368,185 @@ def test_tasks_region_change(env):
 [1]: b
   Skipped
 '''
+
+
+def test_tasks_grass_batch(env):
+    '''Running many GRASS commands as a single task.'''
+    returncode, _, _ = env.run([], '''
+    location = 'foobar'
+
+    [[tasks]]
+    task = 'grass'
+    params = {module='g.proj', c=true, proj4='+proj=utm +zone=33 +datum=WGS84'}
+
+    [[tasks]]
+    task = 'grass_batch'
+    [tasks.params]
+    workers = 2
+    modules = [
+        {module='v.import', input='tests/point.geojson', output='point_a'},
+        {sequence=[
+            {module='v.import', input='tests/point.geojson', output='point_b'},
+            {module='g.copy', vector='point_b,point_c'},
+        ]},
+    ]
+    ''')
+    assert returncode == 0
+    with session(env.gisdbase, 'foobar', mapset='PERMANENT'):
+        from stitches._grass import gcore
+        maps = gcore.read_command(
+            'g.list', type='vector', pattern='point_*').splitlines()
+        assert [m.decode('utf-8') for m in maps] == [
+            'point_a', 'point_b', 'point_c']
+
+
+def test_tasks_grass_batch_failure(env):
+    '''Failures of batched GRASS commands fail the task.'''
+    returncode, _, _ = env.run(['--log', os.devnull], '''
+    location = 'foobar'
+
+    [[tasks]]
+    task = 'grass_batch'
+    [tasks.params]
+    modules = [
+        {module='v.import', input='tests/missing.geojson', output='missing'},
+    ]
+    ''')
+    assert returncode == 1
+
+
+def test_tasks_scratch_mapset(env):
+    '''Tasks may write intermediate maps to a temporary scratch mapset.'''
+    scratch = os.path.join(env.root, 'scratch')
+    os.mkdir(scratch)
+    returncode, _, _ = env.run(['--scratch', scratch], '''
+    location = 'foobar'
+
+    [[tasks]]
+    task = 'grass'
+    params = {module='g.proj', c=true, proj4='+proj=utm +zone=33 +datum=WGS84'}
+
+    [[tasks]]
+    task = 'grass'
+    scratch = true
+    outputs = ['vector/intermediate']
+    params = {module='v.import', input='tests/point.geojson', output='intermediate'}
+
+    [[tasks]]
+    task = 'grass'
+    inputs = ['vector/intermediate']
+    outputs = ['vector/mypoint']
+    params = {module='g.copy', vector='intermediate,mypoint'}
+    ''')
+    assert returncode == 0
+    assert os.listdir(scratch) == []
+    assert sorted(os.listdir(os.path.join(env.gisdbase, 'foobar'))) == [
+        'PERMANENT']
+    with session(env.gisdbase, 'foobar', mapset='PERMANENT'):
+        from stitches._grass import gcore
+        maps = gcore.read_command(
+            'g.list', type='vector', mapset='.', pattern='*').splitlines()
+        assert [m.decode('utf-8') for m in maps] == ['mypoint']
+
+
+def test_tasks_grass_link(env):
+    '''Files are linked into the mapset, rather than copied.'''
+    returncode, _, _ = env.run([], '''
+    location = 'foobar'
+
+    [[tasks]]
+    task = 'grass'
+    params = {module='g.proj', c=true, proj4='+proj=longlat +datum=WGS84'}
+
+    [[tasks]]
+    task = 'grass_link'
+    inputs = ['file/tests/point.geojson']
+    outputs = ['vector/mypoint']
+    params = {type='vector', input='tests/point.geojson', output='mypoint'}
+    ''')
+    assert returncode == 0
+    with session(env.gisdbase, 'foobar', mapset='PERMANENT'):
+        from stitches._grass import gcore
+        info = gcore.parse_command('v.info', flags='e', map='mypoint')
+        assert info['format'] != 'native'
+
+
+def test_tasks_grass_blocks(env):
+    '''Raster maps are processed a block of rows at a time.'''
+    returncode, _, _ = env.run([], '''
+    location = 'foobar'
+
+    [[tasks]]
+    task = 'grass'
+    params = {module='g.proj', c=true, proj4='+proj=utm +zone=33 +datum=WGS84'}
+
+    [[tasks]]
+    task = 'grass'
+    params = {module='g.region', n=100, s=0, e=10, w=0, res=1}
+
+    [[tasks]]
+    task = 'grass'
+    outputs = ['raster/dem']
+    params = {module='r.mapcalc', expression='dem = row()'}
+
+    [[tasks]]
+    task = 'grass_blocks'
+    inputs = ['raster/dem']
+    outputs = ['raster/smooth']
+    params = {function='tests:smooth_rows', inputs=['dem'], output='smooth',
+              rows=7, halo=1, workers=2}
+    ''')
+    assert returncode == 0
+    with session(env.gisdbase, 'foobar', mapset='PERMANENT'):
+        from stitches._grass import gcore
+        info = gcore.parse_command('r.univar', flags='g', map='smooth')
+        assert abs(float(info['mean']) - 50.5) < 1e-6
+        assert int(info['n']) == 1000
+
+
+def test_sweep(env):
+    '''Running a pipeline for many sets of variables, each in a mapset.'''
+    returncode, _, _ = env.run([], '''
+    location = 'foobar'
+
+    [[tasks]]
+    task = 'grass'
+    params = {module='g.proj', c=true, proj4='+proj=utm +zone=33 +datum=WGS84'}
+
+    [[tasks]]
+    task = 'grass'
+    params = {module='v.import', input='tests/point.geojson', output='base'}
+    ''')
+    assert returncode == 0
+
+    instances = os.path.join(env.root, 'instances.csv')
+    with open(instances, 'w') as fp:
+        fp.write('tile\na\nb\n')
+    fopts = dict(mode='w', dir=env.root, prefix='config_', suffix='.toml')
+    with tempfile.NamedTemporaryFile(**fopts) as fp:
+        fp.write('''
+        location = 'foobar'
+
+        [[tasks]]
+        task = 'grass'
+        inputs = ['vector/base@PERMANENT']
+        outputs = ['vector/{{ tile }}']
+        params = {module='g.copy', vector='base@PERMANENT,{{ tile }}'}
+        ''')
+        fp.flush()
+        proc = subprocess.Popen(['stitches', 'sweep', '--gisdbase',
+                                 env.gisdbase, '--mapset', 'tile_{tile}',
+                                 '--workers', '2', fp.name, instances],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        proc.communicate()
+    assert proc.returncode == 0
+    for tile in ['a', 'b']:
+        mapset = 'tile_{}'.format(tile)
+        assert os.path.isfile(os.path.join(
+            env.gisdbase, 'foobar', mapset, 'stitches.state.json'))
+        with session(env.gisdbase, 'foobar', mapset=mapset):
+            from stitches._grass import gcore
+            maps = gcore.read_command(
+                'g.list', type='vector', mapset='.').splitlines()
+            assert [m.decode('utf-8') for m in maps] == [tile]
@@ -13,25 +13,63 @@
 # You should have received a copy of the GNU General Public License
 # along with Stitches. If not, see <https://www.gnu.org/licenses/>.
 
+import collections
 import hashlib
+import itertools
 import json
+import os
+import sys
 
+import colorful
 import jinja2
 import pytest
 import toml
 
+from stitches import tasks
+from stitches import Error
+from stitches import Index
+from stitches import LocationEvent
+from stitches import MetricsReporter
+from stitches import MultiReporter
+from stitches import PlanEvent
+from stitches import Profiler
+from stitches import ProgressReporter
 from stitches import Resource
+from stitches import Runner
+from stitches import State
+from stitches import StateSaveEvent
+from stitches import TaskCompleteEvent
+from stitches import TaskEvent
+from stitches import TaskFatalEvent
+from stitches import TaskSkipEvent
+from stitches import TaskRegistry
+from stitches import TaskStartEvent
 from stitches import TaskStatus
+from stitches import TracedPlatform
+from stitches import TraceReporter
 from stitches import Platform
 from stitches import load
+from stitches import read_instances
 from stitches import analyse
+from stitches import cleanup
+from stitches import estimate_durations
+from stitches import execute
+from stitches import resolve_execution
+from stitches import run
+from stitches import validate
+from tests import dummy_task
 
 
 class PlatformTest(Platform):
     def __init__(self):
+        super(PlatformTest, self).__init__()
         self.value = 0
         self.files = {}
         self.region = {}
+        self.queries = 0
+        self.removed = set()
+        self.digests = {}
+        self.datasets = {}
 
     def file_mtime(self, path):
         return self.value
@@ -39,14 +77,32 @@ class PlatformTest(Platform):
     def file_exists(self, path):
         return self.files.get(path, True)
 
+    def file_manifest(self, path, pattern=None):
+        return str(self.value)
+
+    def file_digest(self, path, pattern=None):
+        return self.digests.get(path, str(self.value))
+
+    def map_digest(self, type_, name):
+        return self.digests.get(name, str(self.value))
+
+    def dataset_maps(self, type_, name):
+        return self.datasets.get(name)
+
     def map_exists(self, type_, name):
-        return True
+        self.queries += 1
+        return name not in self.removed
 
     def region_hash(self):
         hasher = hashlib.md5()
         hasher.update(json.dumps(self.region, sort_keys=True).encode('ascii'))
         return hasher.hexdigest()
 
+    def remove(self, resources, mapset=None):
+        self.removed.update(resource.name if mapset is None else
+                            '{}@{}'.format(resource.name, mapset)
+                            for resource in resources)
+
 
 class PipelineTestState(object):
 
@@ -83,6 +139,15 @@ def test_resource_refs():
     res = Resource('file//foobar/baz.tif')
     assert (res.type, res.path) == (Resource.FILE, '/foobar/baz.tif')
 
+    res = Resource('file/foobar/*.tif')
+    assert ((res.type, res.path, res.pattern) ==
+            (Resource.FILE, 'foobar', '*.tif'))
+    assert res.collection()
+
+    res = Resource('dir/foobar')
+    assert (res.type, res.path, res.pattern) == (Resource.DIR, 'foobar', None)
+    assert res.collection()
+
     res = Resource('vector/mypoint@mydb/myloc/maps')
     assert ((res.type, res.name, res.gisdbase, res.location, res.mapset) ==
             (Resource.VECTOR, 'mypoint', 'mydb', 'myloc', 'maps'))
@@ -289,3 +354,1129 @@ def test_expand_pipeline():
     assert task_event.params == {}
     assert task_event.inputs == []
     assert task_event.outputs == []
+
+
+def test_task_hash_includes_upstream(env):
+    '''Changing a task should change the hash of all downstream tasks.'''
+    pfile = toml.loads(env.example_file)
+    pfile['tasks'][0]['params'] = 1337
+
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': env.example_file,
+        'mypipeline2': toml.dumps(pfile)
+    }))
+
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    next(events)  # Location event
+    before = [task.hash for task in events]
+
+    events = load(jinja_env, {'pipeline': 'mypipeline2'})
+    next(events)  # Location event
+    after = [task.hash for task in events]
+
+    assert len(before) == len(after) == 3
+    for (a, b) in zip(before, after):
+        assert a != b
+
+
+def test_pipeline_subpipeline_skip(env):
+    '''An unchanged sub-pipeline should be skipped as a whole.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        pipeline = 'sub'
+        ''',
+        'sub': env.example_file,
+    }))
+
+    def tasks(events):
+        return [event for event in events if isinstance(event, TaskEvent)]
+
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    next(events)  # Location event
+    events = analyse(events, env.platform, env.history)
+    for task in tasks(events):
+        assert task.status == TaskStatus.RUN
+
+    env.platform.queries = 0
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    next(events)  # Location event
+    events = analyse(events, env.platform, env.history)
+    statuses = [task.status for task in tasks(events)]
+    assert statuses == [TaskStatus.SKIP] * 3
+    # Only the outputs left by the sub-pipeline are checked
+    assert env.platform.queries == 2
+
+    env.platform.value += 1
+
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    next(events)  # Location event
+    events = analyse(events, env.platform, env.history)
+    statuses = [task.status for task in tasks(events)]
+    assert statuses == [TaskStatus.RUN] * 3
+
+
+def test_expand_generator_pipeline(env):
+    '''Python generator pipelines are expanded lazily.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        pipeline = 'tests:tile_pipeline'
+        params = {vars={prefix='dem'}}
+        '''
+    }))
+
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    next(events)  # Location event
+    location_event = next(events)
+    assert location_event.hash is None
+
+    events = analyse(events, env.platform, env.history)
+    tasks = list(itertools.islice(events, 3))
+    assert [task.ref for task in tasks] == ['0/0', '0/1', '0/2']
+    assert [task.outputs[0].name for task in tasks] == [
+        'dem_0', 'dem_1', 'dem_2']
+    for task in tasks:
+        assert task.status == TaskStatus.RUN
+
+
+class EntryPointTest(object):
+    def __init__(self, function):
+        self.function = function
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return self.function
+
+
+def test_task_registry_resolve():
+    '''Tasks are resolved from entry points, builtins and references.'''
+    entry_point = EntryPointTest(dummy_task)
+    registry = TaskRegistry(entry_points={'dummy': entry_point})
+
+    assert registry.resolve(TaskEvent('dummy')) is dummy_task
+    assert registry.resolve(TaskEvent('dummy')) is dummy_task
+    assert entry_point.loads == 1
+
+    assert registry.resolve(TaskEvent('script')) is tasks.script
+    assert registry.resolve(TaskEvent('tests:dummy_task')) is dummy_task
+
+    for name in ['nonexistent', 'subprocess', 'tests:nonexistent']:
+        with pytest.raises(Error):
+            registry.resolve(TaskEvent(name))
+
+
+def test_task_registry_validate():
+    '''All tasks are validated, including their params, before running.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        task = 'script'
+        params = {cmd=['ls']}
+
+        [[tasks]]
+        task = 'script'
+        params = {command=['ls']}
+
+        [[tasks]]
+        task = 'scirpt'
+        '''
+    }))
+
+    registry = TaskRegistry(entry_points={})
+    with pytest.raises(Error) as excinfo:
+        validate(load(jinja_env, {'pipeline': 'mypipeline'}), registry)
+    lines = excinfo.value.message.splitlines()
+    assert len(lines) == 2
+    assert lines[0].startswith('Invalid params for task "script"')
+    assert lines[1].startswith('Task "scirpt" not found')
+
+
+def test_pipeline_records_durations(env):
+    '''The duration of tasks that ran is retained in the history.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': env.example_file
+    }))
+
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    next(events)  # Location event
+    for (i, task) in enumerate(analyse(events, env.platform, env.history)):
+        task.duration = float(i + 1)
+
+    durations = sorted(entry['duration'] for entry in env.history.values())
+    assert durations == [1.0, 2.0, 3.0]
+    assert set(entry['task'] for entry in env.history.values()) == set([
+        'foo', 'bar', 'baz'])
+
+
+def test_progress_reporter_estimates(capsys):
+    '''Remaining time is estimated from previous durations by task name.'''
+    colorful.disable()  # pylint: disable=no-member
+    history = {'a': {'task': 'grass', 'duration': 10.0}}
+    tasks = [TaskEvent('grass', ref=str(i), hash_=str(i), message=str(i),
+                       status=TaskStatus.RUN) for i in range(4)]
+    reporter = ProgressReporter(history)
+    reporter(PlanEvent(tasks))
+
+    reporter(TaskStartEvent('0', '0', task=tasks[0]))
+    tasks[0].duration = 30.0
+    reporter(TaskCompleteEvent(tasks[0]))
+    reporter(TaskStartEvent('1', '1', task=tasks[1]))
+
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == '[0]: 0 (0%, 40s remaining)'
+    assert lines[1] == '  Completed in 30s'
+    assert lines[2] == '  Slower than previous runs (30s vs 10s)'
+    assert lines[3] == '[1]: 1 (33%, 1m00s remaining)'
+
+
+def test_metrics_reporter(tmpdir):
+    '''Metrics are written in the OpenMetrics text format after each event.'''
+    path = str(tmpdir.join('stitches.prom'))
+    reporter = MetricsReporter(path, pipeline='mypipeline')
+
+    tasks = [TaskEvent('grass', ref=str(i), planning=0.25) for i in range(3)]
+    tasks[0].duration = 2.0
+    for (task, event) in zip(tasks, [TaskCompleteEvent, TaskSkipEvent]):
+        reporter(TaskStartEvent(task.ref, '', task=task))
+        reporter(event(task))
+    reporter(StateSaveEvent(0.5))
+    reporter(TaskStartEvent(tasks[2].ref, '', task=tasks[2]))
+    reporter(TaskFatalEvent('Traceback'))
+
+    with open(path) as fp:
+        lines = fp.read().splitlines()
+
+    def metric(name, **labels):
+        labels['pipeline'] = 'mypipeline'
+        prefix = '{}{{{}}} '.format(name, ','.join(
+            '{}="{}"'.format(*item) for item in sorted(labels.items())))
+        values = [line[len(prefix):] for line in lines
+                  if line.startswith(prefix)]
+        assert len(values) == 1
+        return float(values[0])
+
+    assert metric('stitches_tasks_total', status='completed') == 1
+    assert metric('stitches_tasks_total', status='skipped') == 1
+    assert metric('stitches_tasks_total', status='failed') == 1
+    assert metric('stitches_cache_hit_ratio') == 0.5
+    assert metric('stitches_task_duration_seconds_bucket',
+                  task='grass', le='1.0') == 0
+    assert metric('stitches_task_duration_seconds_bucket',
+                  task='grass', le='5.0') == 1
+    assert metric('stitches_task_duration_seconds_bucket',
+                  task='grass', le='+Inf') == 1
+    assert metric('stitches_task_duration_seconds_sum', task='grass') == 2.0
+    assert metric('stitches_planning_seconds_total') == 0.5
+    assert metric('stitches_state_save_seconds_total') == 0.5
+    assert lines[-1] == '# EOF'
+
+
+def test_trace_reporter(tmpdir, env):
+    '''All events are written to a timeline, including platform queries.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': env.example_file
+    }))
+    jsonl_path = str(tmpdir.join('trace.jsonl'))
+    chrome_path = str(tmpdir.join('trace.json'))
+    traces = [TraceReporter(jsonl_path),
+              TraceReporter(chrome_path, TraceReporter.CHROME)]
+    reporter = MultiReporter(*traces)
+    platform = TracedPlatform(env.platform, reporter)
+
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    events = analyse(events, platform, env.history)
+    for event in execute(events, None, None,
+                         registry=TaskRegistry(entry_points={
+                             name: EntryPointTest(dummy_task)
+                             for name in ['foo', 'bar', 'baz']})):
+        reporter(event)
+    reporter(StateSaveEvent(0.1))
+    for trace in traces:
+        trace.close()
+
+    with open(jsonl_path) as fp:
+        records = [json.loads(line) for line in fp]
+    kinds = [record['event'] for record in records]
+    assert kinds.count('pipeline') == 1
+    assert kinds.count('task_load') == 3
+    assert kinds.count('task_plan') == 3
+    assert kinds.count('task_complete') == 3
+    assert kinds.count('platform_query') > 0
+    assert kinds[-1] == 'state_save'
+    timestamps = [record['ts'] for record in records
+                  if record['event'] == 'task_complete']
+    assert timestamps == sorted(timestamps)
+
+    with open(chrome_path) as fp:
+        trace = json.load(fp)
+    complete = [event for event in trace['traceEvents']
+                if event['ph'] == 'X' and event['cat'] == 'task_complete']
+    assert [event['name'] for event in complete] == ['0', '1', '2']
+    assert all(event['ts'] >= 0 for event in trace['traceEvents']
+               if event['ph'] != 'M')
+
+
+def test_trace_reporter_cleanup(tmpdir, env):
+    '''Removing temporary resources is written to the trace.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        task = 'foo'
+        outputs = ['raster/tmp']
+        temporary = ['raster/tmp']
+        '''
+    }))
+    jsonl_path = str(tmpdir.join('trace.jsonl'))
+    trace = TraceReporter(jsonl_path)
+    platform = TracedPlatform(env.platform, trace)
+
+    index = Index.build(load(jinja_env, {'pipeline': 'mypipeline'}))
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    events = analyse(events, platform, env.history, index=index)
+    events = execute(events, None, None, registry=TaskRegistry(
+        entry_points={'foo': EntryPointTest(dummy_task)}))
+    for event in cleanup(events, index, platform, env.history):
+        trace(event)
+    trace.close()
+
+    with open(jsonl_path) as fp:
+        records = [json.loads(line) for line in fp]
+    removes = [record['args']['args'] for record in records
+               if record['event'] == 'platform_query' and
+               record['name'] == 'remove']
+    assert removes == [[['raster/tmp'], None]]
+
+
+def test_profiler(tmpdir):
+    '''Selected tasks are profiled, with a summary across all of them.'''
+    directory = str(tmpdir.join('profile'))
+    profiler = Profiler(directory, refs=['1/0'], memory=True)
+
+    def allocate(size=0):
+        return [0] * size
+
+    assert profiler.wrap(TaskEvent('foo', ref='0'), allocate) is allocate
+    assert len(profiler.wrap(TaskEvent('foo', ref='1/0'), allocate)(
+        size=1000)) == 1000
+
+    assert sorted(os.listdir(directory)) == [
+        '1_0.allocations.txt', '1_0.pstats']
+    summary = profiler.summary()
+    with open(summary) as fp:
+        assert 'allocate' in fp.read()
+
+
+def test_execution_profiles():
+    '''Execution profiles are inherited, with tasks taking precedence.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        execution = {nprocs='auto', memory=2000}
+
+        [[tasks]]
+        task = 'foo'
+
+        [[tasks]]
+        pipeline = 'sub'
+        execution = {memory=1000}
+
+        [[tasks]]
+        task = 'bar'
+        execution = {nprocs=2}
+        ''',
+        'sub': '''
+        execution = 'auto'
+
+        [[tasks]]
+        task = 'baz'
+        execution = {compressor='ZSTD'}
+        '''
+    }))
+
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    profiles = [event.execution for event in events
+                if isinstance(event, TaskEvent)]
+    assert profiles == [
+        {'nprocs': 'auto', 'memory': 2000},
+        {'nprocs': 'auto', 'memory': 1000, 'omp_threads': 'auto',
+         'compressor': 'ZSTD'},
+        {'nprocs': 2, 'memory': 2000},
+    ]
+
+    resolved = resolve_execution(profiles[1], cpus=8, memory=4000)
+    assert resolved == {'nprocs': 8, 'memory': 1000, 'omp_threads': 8,
+                        'compressor': 'ZSTD'}
+    resolved = resolve_execution({'memory': 'auto'}, memory=4000)
+    assert resolved == {'memory': 3000}
+    resolved = resolve_execution({'nprocs': 2, 'omp_threads': 'auto'})
+    assert resolved == {'nprocs': 2, 'omp_threads': 2}
+
+
+def test_index_temporary_expiry():
+    '''Temporary resources expire after the last task using them.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        task = 'a'
+        outputs = ['raster/tmp', 'raster/unused']
+        temporary = ['raster/tmp', 'raster/unused']
+
+        [[tasks]]
+        task = 'b'
+        inputs = ['raster/tmp']
+
+        [[tasks]]
+        task = 'c'
+        inputs = ['raster/tmp']
+        outputs = ['raster/result']
+        '''
+    }))
+    index = Index.build(load(jinja_env, {'pipeline': 'mypipeline'}))
+    assert [(r.ref(), p.ref) for (r, p) in index.expiry['0']] == [
+        ('raster/unused', '0')]
+    assert [(r.ref(), p.ref) for (r, p) in index.expiry['2']] == [
+        ('raster/tmp', '0')]
+    assert [task.ref for task in index.consumers['raster/tmp']] == ['1', '2']
+    assert [task.ref for task in index.producers['raster/result']] == ['2']
+    # Tasks are indexed as they are streamed, without their params
+    assert not hasattr(index.tasks[0], 'params')
+
+
+def test_pipeline_temporary_cleanup(env):
+    '''Temporary outputs are removed, and recreated only when needed.'''
+    pipeline = '''
+    [[tasks]]
+    task = 'foo'
+    inputs = ['file/foo.txt']
+    outputs = ['raster/tmp']
+    temporary = ['raster/tmp']
+
+    [[tasks]]
+    task = 'bar'
+    inputs = ['raster/tmp']
+    outputs = ['raster/result']
+    params = {{ params }}
+    '''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': pipeline,
+    }))
+    registry = TaskRegistry(entry_points={
+        name: EntryPointTest(dummy_task) for name in ['foo', 'bar']})
+
+    def run(params):
+        options = {'pipeline': 'mypipeline', 'params': {
+            'vars': {'params': params}}}
+        index = Index.build(load(jinja_env, options))
+        events = load(jinja_env, options)
+        next(events)  # Location event
+        events = analyse(events, env.platform, env.history, index=index)
+        events = execute(events, None, None, registry=registry)
+        events = cleanup(events, index, env.platform, env.history)
+        return [event.task.status for event in events
+                if isinstance(event, (TaskCompleteEvent, TaskSkipEvent))]
+
+    assert run('{}') == [TaskStatus.RUN, TaskStatus.RUN]
+    assert env.platform.removed == set(['tmp'])
+    assert run('{}') == [TaskStatus.SKIP, TaskStatus.SKIP]
+
+    # Looking ahead at the consumers of a temporary output is not part of the
+    # decisions of the task that created it
+    options = {'pipeline': 'mypipeline', 'params': {
+        'vars': {'params': '{}'}}}
+    index = Index.build(load(jinja_env, options))
+    events = load(jinja_env, options)
+    next(events)  # Location event
+    tasks = [event for event in analyse(events, env.platform, env.history,
+                                        index=index)
+             if isinstance(event, TaskEvent)]
+    assert 'raster/result' not in [ref for (_, ref, _) in tasks[0].decisions]
+
+    assert run('{a=1}') == [TaskStatus.RUN, TaskStatus.RUN]
+
+
+def test_pipeline_temporary_later_creator(env):
+    '''Temporaries are recreated for tasks whose other inputs change.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        task = 'make'
+        outputs = ['raster/t']
+        temporary = ['raster/t']
+
+        [[tasks]]
+        task = 'foo'
+        inputs = ['file/b.txt']
+        outputs = ['raster/o']
+
+        [[tasks]]
+        task = 'bar'
+        inputs = ['raster/t', 'raster/o']
+        outputs = ['raster/r']
+        '''
+    }))
+
+    def make(**_):
+        env.platform.removed.discard('t')
+
+    registry = TaskRegistry(entry_points={
+        'make': EntryPointTest(make), 'foo': EntryPointTest(dummy_task),
+        'bar': EntryPointTest(dummy_task)})
+    options = {'pipeline': 'mypipeline'}
+    index = Index.build(load(jinja_env, options))
+
+    def run(**kwargs):
+        events = load(jinja_env, options)
+        next(events)  # Location event
+        events = analyse(events, env.platform, env.history, index=index,
+                         **kwargs)
+        events = execute(events, None, None, registry=registry)
+        events = cleanup(events, index, env.platform, env.history)
+        return [event.task.status for event in events
+                if isinstance(event, (TaskCompleteEvent, TaskSkipEvent))]
+
+    assert run() == [TaskStatus.RUN] * 3
+    assert env.platform.removed == set(['t'])
+    assert run() == [TaskStatus.SKIP] * 3
+    env.platform.value += 1
+    assert run() == [TaskStatus.RUN] * 3
+    assert env.platform.removed == set(['t'])
+
+    # The creator of a temporary is skipped regardless
+    env.platform.value += 1
+    with pytest.raises(Error) as excinfo:
+        run(skip=['0'])
+    assert 'temporary input raster/t was removed' in str(excinfo.value)
+
+
+def test_scratch_outputs_temporary():
+    '''Outputs of tasks run in the scratch mapset are temporary.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        task = 'foo'
+        scratch = true
+        outputs = ['raster/a', 'raster/b']
+
+        [[tasks]]
+        task = 'bar'
+        inputs = ['raster/a']
+        '''
+    }))
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    next(events)  # Location event
+    task = next(events)
+    assert task.scratch
+    assert [r.ref() for r in task.temporary] == ['raster/a', 'raster/b']
+    assert not next(events).scratch
+
+    # Removed from the scratch mapset, rather than the current mapset
+    platform = PlatformTest()
+    index = Index.build(load(jinja_env, {'pipeline': 'mypipeline'}))
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    next(events)  # Location event
+    completed = []
+    for task in events:
+        task.status = TaskStatus.RUN
+        completed.append(TaskCompleteEvent(task))
+    list(cleanup(iter(completed), index, platform, {}, scratch='scratch'))
+    assert platform.removed == set(['a@scratch', 'b@scratch'])
+
+
+def test_scratch_initial_location():
+    '''Scratch and staging mapsets are only used in the initial location.'''
+    class StageTest(object):
+        def wants(self, task):
+            raise AssertionError(task)
+
+    registry = TaskRegistry(entry_points={'foo': EntryPointTest(dummy_task)})
+    place = ('db', 'home', 'PERMANENT')
+    events = [
+        LocationEvent(location='other'),
+        TaskEvent('foo', params={}, inputs=[Resource('raster/a')],
+                  outputs=[], removes=[], status=TaskStatus.RUN),
+        TaskEvent('foo', pipeline='mypipeline', ref='1', params={},
+                  status=TaskStatus.RUN, scratch=True),
+    ]
+    events = execute(iter(events), None, None, registry=registry,
+                     scratch='scratch', stage=StageTest(), place=place)
+    assert isinstance(next(events), LocationEvent)
+    assert isinstance(next(events), TaskStartEvent)
+    assert isinstance(next(events), TaskCompleteEvent)
+    next(events)
+    with pytest.raises(Error) as excinfo:
+        next(events)
+    assert 'only available in the initial location' in str(excinfo.value)
+
+
+def test_file_collection_manifest(tmpdir):
+    '''Globs and directories are invalidated when any of their files change.'''
+    class LocalPlatform(PlatformTest):
+        file_manifest = Platform.file_manifest
+        file_exists = Platform.file_exists
+
+    tiles = tmpdir.mkdir('tiles')
+    tiles.join('a.tif').write('a')
+    tiles.join('notes.txt').write('b')
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        task = 'foo'
+        inputs = ['file/{0}/*.tif']
+        outputs = ['vector/foo']
+
+        [[tasks]]
+        task = 'bar'
+        inputs = ['dir/{0}']
+        outputs = ['vector/bar']
+        '''.format(tiles)
+    }))
+    platform = LocalPlatform()
+    history = {}
+
+    def statuses():
+        events = load(jinja_env, {'pipeline': 'mypipeline'})
+        next(events)  # Location event
+        return [t.status for t in analyse(events, platform, history)]
+
+    assert statuses() == [TaskStatus.RUN, TaskStatus.RUN]
+    assert statuses() == [TaskStatus.SKIP, TaskStatus.SKIP]
+    # Only a single checksum is kept for all of the files
+    assert all(len(h['inputs']) == 1 for h in history.values())
+
+    tiles.join('notes.txt').write('changed')
+    assert statuses() == [TaskStatus.SKIP, TaskStatus.RUN]
+
+    tiles.join('b.tif').write('new')
+    assert statuses() == [TaskStatus.RUN, TaskStatus.RUN]
+    assert statuses() == [TaskStatus.SKIP, TaskStatus.SKIP]
+
+
+def test_state_namespaces(tmpdir):
+    '''Pipelines keep their own history in a shared state file.'''
+    path = str(tmpdir.join('stitches.state.json'))
+    with open(path, 'w') as fp:
+        json.dump({'history': {'abc': {'region': 'r'}}}, fp)
+
+    first = State.load(path, namespace='first.toml')
+    assert first.history == {'abc': {'region': 'r'}}
+    second = State.load(path, namespace='second.toml')
+    first.history = {'def': {}}
+    first.save()
+    second.history['ghi'] = {}
+    second.save()
+
+    assert State.load(path, namespace='first.toml').history == {'def': {}}
+    assert set(State.load(path, namespace='second.toml').history) == set([
+        'abc', 'ghi'])
+    assert State.load(path, namespace='third.toml').history == {}
+    assert [p for p in os.listdir(str(tmpdir))
+            if not p.endswith('.lock')] == ['stitches.state.json']
+
+
+def test_state_lock(tmpdir):
+    '''The same pipeline can not be run twice at once.'''
+    path = str(tmpdir.join('stitches.state.json'))
+    first = State(path, namespace='first.toml')
+    with first.lock():
+        with State(path, namespace='second.toml').lock():
+            pass
+        with pytest.raises(Error):
+            with State(path, namespace='first.toml').lock():
+                pass
+    with first.lock():
+        pass
+
+
+def test_index_downstream(env):
+    '''Changes to a resource affect every task downstream of it.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        task = 'foo'
+        inputs = ['file/data/a.tif']
+        outputs = ['raster/a']
+
+        [[tasks]]
+        task = 'bar'
+        inputs = ['raster/a']
+        outputs = ['raster/b']
+
+        [[tasks]]
+        task = 'foo'
+        inputs = ['file/data/*.tif']
+        outputs = ['raster/c']
+
+        [[tasks]]
+        task = 'baz'
+        outputs = ['raster/b']
+
+        [[tasks]]
+        task = 'bar'
+        inputs = ['raster/b']
+        '''
+    }))
+    index = Index.build(load(jinja_env, {'pipeline': 'mypipeline'}))
+    assert [t.ref for t in index.downstream(['file/data/a.tif'])] == [
+        '0', '1', '2']
+    assert [t.ref for t in index.downstream(['raster/b'])] == []
+    assert [t.ref for t in index.downstream(['file/data/b.tif'])] == ['2']
+
+    affected = index.downstream(['file/data/a.tif'])
+    history = {
+        affected[0].hash: {'task': 'foo', 'duration': 10.0},
+        'previous': {'task': 'foo', 'duration': 20.0},
+    }
+    assert list(estimate_durations(affected, history).items()) == [
+        ('0', 10.0), ('1', None), ('2', 15.0)]
+
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    next(events)  # Location event
+    list(analyse(events, env.platform, env.history))
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    next(events)  # Location event
+    events = analyse(events, env.platform, env.history,
+                     invalidated=[t.ref for t in affected])
+    assert [t.status for t in events] == [
+        TaskStatus.RUN, TaskStatus.RUN, TaskStatus.RUN, TaskStatus.SKIP,
+        TaskStatus.SKIP]
+
+
+def test_run_api(tmpdir, monkeypatch):
+    '''Pipelines are run from python, returning a result.'''
+    monkeypatch.setenv('GISRC', str(tmpdir.join('gisrc')))
+    tmpdir.mkdir('grassdata').mkdir('loc').mkdir('PERMANENT')
+    pipeline = tmpdir.join('pipeline.toml')
+    pipeline.write('''
+    [[tasks]]
+    task = 'foo'
+    outputs = ['raster/a']
+
+    [[tasks]]
+    task = '{{ task }}'
+    inputs = ['raster/a']
+    ''')
+    registry = TaskRegistry(entry_points={
+        'foo': EntryPointTest(dummy_task),
+        'fails': EntryPointTest(lambda: 1 / 0),
+    })
+    runner = Runner(platform=PlatformTest(), registry=registry)
+    options = dict(gisdbase=str(tmpdir.join('grassdata')), location='loc',
+                   mapset='PERMANENT', runner=runner)
+
+    result = run(str(pipeline), vars={'task': 'foo'}, **options)
+    assert result.ok
+    assert list(result.statuses.items()) == [
+        ('0', TaskStatus.RUN), ('1', TaskStatus.RUN)]
+    assert list(result.durations) == ['0', '1']
+
+    result = run(str(pipeline), vars={'task': 'foo'}, **options)
+    assert list(result.statuses.values()) == [
+        TaskStatus.SKIP, TaskStatus.SKIP]
+
+    result = run(str(pipeline), vars={'task': 'fails'}, **options)
+    assert not result.ok
+    assert 'ZeroDivisionError' in result.errors[0]
+    assert list(result.statuses.items()) == [
+        ('0', TaskStatus.SKIP), ('1', TaskStatus.FAIL)]
+
+
+def test_sweep_instances(tmpdir):
+    '''Variables of each instance of a sweep are read from CSV or JSONL.'''
+    table = tmpdir.join('tiles.csv')
+    table.write('tile,zone\na,33\nb,32\n')
+    assert read_instances(str(table)) == [
+        {'tile': 'a', 'zone': '33'}, {'tile': 'b', 'zone': '32'}]
+
+    table = tmpdir.join('tiles.jsonl')
+    table.write('{"tile": "a", "zone": 33}\n\n{"tile": "b", "zone": 32}\n')
+    assert read_instances(str(table)) == [
+        {'tile': 'a', 'zone': 33}, {'tile': 'b', 'zone': 32}]
+
+
+def test_pipeline_early_cutoff(env):
+    '''Tasks are skipped when a task they use reproduces the same outputs.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        task = 'foo'
+        inputs = ['file/foo.txt']
+        outputs = ['raster/a']
+
+        [[tasks]]
+        task = 'bar'
+        inputs = ['raster/a']
+        outputs = ['raster/b']
+
+        [[tasks]]
+        task = 'baz'
+        inputs = ['raster/b']
+        '''
+    }))
+    env.platform.digests['a'] = 'same'
+
+    def statuses():
+        events = load(jinja_env, {'pipeline': 'mypipeline'})
+        next(events)  # Location event
+        return [t.status for t in analyse(events, env.platform, env.history)]
+
+    assert statuses() == [TaskStatus.RUN] * 3
+    env.platform.value += 1
+    assert statuses() == [TaskStatus.RUN, TaskStatus.SKIP, TaskStatus.SKIP]
+
+    env.platform.digests['a'] = 'different'
+    env.platform.value += 1
+    assert statuses() == [TaskStatus.RUN] * 3
+
+
+def test_pipeline_early_cutoff_consumed(env):
+    '''Tasks are run when they have not yet used the latest outputs.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        task = 'foo'
+        inputs = ['file/foo.txt']
+        outputs = ['raster/a']
+
+        [[tasks]]
+        task = 'bar'
+        inputs = ['raster/a']
+        outputs = ['raster/b']
+        '''
+    }))
+
+    def statuses(**kwargs):
+        events = load(jinja_env, {'pipeline': 'mypipeline'})
+        next(events)  # Location event
+        return [t.status for t in analyse(events, env.platform, env.history,
+                                          **kwargs)]
+
+    env.platform.digests['a'] = 'd1'
+    assert statuses() == [TaskStatus.RUN] * 2
+    env.platform.digests['a'] = 'd2'
+    env.platform.value += 1
+    assert statuses(skip=['1']) == [TaskStatus.RUN, TaskStatus.SKIP]
+    env.platform.value += 1
+    assert statuses() == [TaskStatus.RUN, TaskStatus.RUN]
+    assert statuses() == [TaskStatus.SKIP, TaskStatus.SKIP]
+
+
+def test_registry_fingerprint(tmpdir, monkeypatch):
+    '''Fingerprints cover the source of a task, and the GRASS version.'''
+    tmpdir.join('mytasks.py').write('def foo(**_):\n    pass\n')
+    monkeypatch.syspath_prepend(str(tmpdir))
+    registry = TaskRegistry(entry_points={}, grass_version='7.6.1')
+    python_task = TaskEvent('mytasks:foo')
+    grass_task = TaskEvent('grass')
+    fingerprint = registry.fingerprint(python_task)
+    assert fingerprint == registry.fingerprint(TaskEvent('mytasks:foo'))
+    assert fingerprint != registry.fingerprint(grass_task)
+
+    other = TaskRegistry(entry_points={}, grass_version='7.8.0')
+    assert other.fingerprint(python_task) == fingerprint
+    assert other.fingerprint(grass_task) != registry.fingerprint(grass_task)
+
+    # Built-in tasks do not share a fingerprint of the whole module
+    assert (registry.fingerprint(TaskEvent('grass_link')) !=
+            registry.fingerprint(grass_task))
+
+
+def test_pipeline_code_change(env):
+    '''Tasks are run when the code they run changes, if tracked.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': env.example_file,
+        'parent': '''
+        [[tasks]]
+        pipeline = 'mypipeline'
+        ''',
+    }))
+    code = {'foo': 'a', 'bar': 'a'}
+
+    def statuses(fingerprint, pipeline='mypipeline', **kwargs):
+        events = load(jinja_env, {'pipeline': pipeline})
+        next(events)  # Location event
+        events = analyse(events, env.platform, env.history,
+                         fingerprint=fingerprint, **kwargs)
+        return [t.status for t in events if isinstance(t, TaskEvent)]
+
+    fingerprint = lambda task: code.get(task.task)
+    statuses(None)
+    assert statuses(fingerprint) == [TaskStatus.SKIP] * 3
+    assert statuses(fingerprint) == [TaskStatus.SKIP] * 3
+    code['bar'] = 'b'
+    assert statuses(fingerprint, skip=['1']) == [TaskStatus.SKIP] * 3
+    assert statuses(fingerprint) == [
+        TaskStatus.SKIP, TaskStatus.RUN, TaskStatus.SKIP]
+    assert statuses(None) == [TaskStatus.SKIP] * 3
+
+    # Sub-pipelines are not skipped as a whole when their code changes
+    statuses(None, 'parent')
+    assert statuses(fingerprint, 'parent') == [TaskStatus.SKIP] * 3
+    code['foo'] = 'b'
+    assert statuses(fingerprint, 'parent') == [
+        TaskStatus.RUN, TaskStatus.SKIP, TaskStatus.SKIP]
+    assert statuses(fingerprint, 'parent') == [TaskStatus.SKIP] * 3
+
+
+def test_session_location_templates(tmpdir, monkeypatch):
+    '''Locations are copied from a template, created once per projection.'''
+    # pylint: disable=protected-access
+    calls = []
+
+    def process(cmd):
+        calls.append(cmd)
+        permanent = os.path.join(cmd[-1], 'PERMANENT')
+        os.makedirs(permanent)
+        for name in ['DEFAULT_WIND', 'WIND', 'PROJ_INFO']:
+            with open(os.path.join(permanent, name), 'w') as fp:
+                fp.write(cmd[2])
+        return (0, '', '')
+
+    # The module is shadowed by the session function of the package
+    session_module = sys.modules['stitches.session']
+    monkeypatch.setattr(session_module, '_process', process)
+    templates = str(tmpdir.join('templates'))
+    for name in ['a', 'b']:
+        location = str(tmpdir.join(name))
+        session_module._create_location('grass', location, c='EPSG:4326',
+                                        templates=templates)
+        session_module._create_mapset(location, 'mymapset')
+        with open(os.path.join(location, 'mymapset', 'WIND')) as fp:
+            assert fp.read() == 'EPSG:4326'
+    session_module._create_location('grass', str(tmpdir.join('c')),
+                                    c='EPSG:3857', templates=templates)
+    assert [cmd[2] for cmd in calls] == ['EPSG:4326', 'EPSG:3857']
+    assert len(os.listdir(templates)) == 2
+
+    # Created at the same time by another process
+    session_module._create_location('grass', str(tmpdir.join('a')),
+                                    c='EPSG:4326', templates=templates)
+    assert sorted(os.listdir(str(tmpdir))) == ['a', 'b', 'c', 'templates']
+
+
+def test_stage_raster_copy(tmpdir):
+    '''Raster maps are copied file by file, replacing any previous copy.'''
+    # pylint: disable=protected-access
+    session_module = sys.modules['stitches.session']
+    (home, stage) = (tmpdir.join('home'), tmpdir.join('stage'))
+    home.join('cell', 'dem').write('a', ensure=True)
+    home.join('cellhd', 'dem').write('a', ensure=True)
+    home.join('cell_misc', 'dem', 'range').write('a', ensure=True)
+    home.join('vector', 'dem', 'coor').write('a', ensure=True)
+    home.join('colr2', 'PERMANENT', 'dem').write('a', ensure=True)
+    home.join('quant2', 'PERMANENT', 'dem').write('a', ensure=True)
+    home.join('colr2', 'PERMANENT', 'roads').write('a', ensure=True)
+    stage.join('colr', 'dem').write('b', ensure=True)
+    stage.join('colr2', 'other', 'dem').write('b', ensure=True)
+
+    session_module._copy_raster(str(home), str(stage), 'dem')
+    assert stage.join('cell', 'dem').read() == 'a'
+    assert stage.join('cell_misc', 'dem', 'range').read() == 'a'
+    assert stage.join('colr2', 'PERMANENT', 'dem').read() == 'a'
+    assert stage.join('quant2', 'PERMANENT', 'dem').read() == 'a'
+    assert not stage.join('colr2', 'PERMANENT', 'roads').exists()
+    assert not stage.join('colr2', 'other', 'dem').exists()
+    assert not stage.join('colr', 'dem').exists()
+    assert not stage.join('vector').exists()
+
+    task = TaskEvent('foo', inputs=[Resource('file/a.txt')],
+                     outputs=[Resource('raster/dem@PERMANENT')], removes=[])
+    staged = session_module.Stage(str(tmpdir), 'loc', 'home', 'stage')
+    assert not staged.wants(task)
+    task.outputs.append(Resource('vector/roads'))
+    assert staged.wants(task)
+
+
+def test_raster_blocks():
+    '''Blocks of rows cover the region once, with a halo clipped at edges.'''
+    # pylint: disable=protected-access
+    blocks = list(tasks._blocks(10, 4, 1))
+    assert blocks == [(0, 4, 0, 5), (4, 8, 3, 9), (8, 10, 7, 10)]
+    assert list(tasks._blocks(10, 4, 0))[1] == (4, 8, 4, 8)
+
+
+def test_session_pool(tmpdir, monkeypatch):
+    '''Each location is given its own GISRC file, created once.'''
+    session_module = sys.modules['stitches.session']
+    initial = tmpdir.join('gisrc')
+    initial.write('')
+    tmpdir.join('gisdbase', 'other', 'PERMANENT', 'DEFAULT_WIND').write(
+        'wind', ensure=True)
+    monkeypatch.setenv('GISRC', str(initial))
+    gisdbase = str(tmpdir.join('gisdbase'))
+
+    pool = session_module.SessionPool(gisdbase, 'initial')
+    assert not pool.switch(gisdbase, 'initial', 'PERMANENT')
+    assert pool.switch(gisdbase, 'other', 'mymapset')
+    gisrc = os.environ['GISRC']
+    with open(gisrc) as fp:
+        assert 'LOCATION_NAME: other\nMAPSET: mymapset\n' in fp.read()
+    assert tmpdir.join('gisdbase', 'other', 'mymapset', 'WIND').read() == 'wind'
+    pool.switch(gisdbase, 'initial')
+    pool.switch(gisdbase, 'other', 'mymapset')
+    assert os.environ['GISRC'] == gisrc
+    pool.close()
+    assert os.environ['GISRC'] == str(initial)
+    assert not os.path.exists(gisrc)
+
+
+def test_location_history(tmpdir):
+    '''The history of tasks is kept in the state of their location.'''
+    from stitches.runner import _LocationHistory
+    tmpdir.join('b', 'PERMANENT').ensure(dir=True)
+    initial = State(str(tmpdir.join('a', 'PERMANENT', 'stitches.state.json')),
+                    history={'x': {'region': 1}}, namespace='p.toml')
+    history = _LocationHistory(Runner(), initial)
+    history.switch(str(tmpdir), 'b', 'PERMANENT')
+    assert 'x' not in history and history.get('x') is None
+    history['y'] = {'region': 2}
+    assert sorted(history.keys()) == ['x', 'y']
+    del history['x']
+    history.switch(str(tmpdir), 'a', 'PERMANENT')
+    assert dict(initial.history) == {}
+    assert list(history.states.values())[1].history == {'y': {'region': 2}}
+    history.close()
+
+
+def test_explain(env):
+    '''The reason for the status of each task is recorded.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        task = 'foo'
+        inputs = ['file/foo.txt']
+        outputs = ['raster/a']
+
+        [[tasks]]
+        task = 'bar'
+        inputs = ['raster/a']
+        outputs = ['raster/b']
+        '''
+    }))
+
+    def reasons():
+        events = load(jinja_env, {'pipeline': 'mypipeline'})
+        next(events)  # Location event
+        return [t.reason for t in analyse(events, env.platform, env.history)
+                if isinstance(t, TaskEvent)]
+
+    reasons()
+    assert reasons() == ['outputs exist and inputs are unchanged'] * 2
+    env.platform.value += 1
+    assert reasons() == [
+        'input file/foo.txt was modified, from 0 to 1',
+        'input raster/a was changed by task 0']
+    env.platform.region = {'n': 1}
+    assert reasons()[0].startswith('region changed from ')
+    env.platform.removed.add('b')
+    assert reasons()[1] == 'output raster/b does not exist'
+
+    events = load(jinja_env, {'pipeline': 'mypipeline'})
+    next(events)  # Location event
+    task = next(analyse(events, env.platform, env.history, force=True))
+    assert task.reason == 'forced to run'
+    assert task.decisions == [('_forced', '0', True)]
+
+
+def test_dataset_changes(env):
+    '''Tasks are given only the maps newly registered in a dataset.'''
+    jinja_env = jinja2.Environment(loader=jinja2.DictLoader({
+        'mypipeline': '''
+        [[tasks]]
+        task = 'foo'
+        inputs = ['strds/temperature']
+        outputs = ['raster/latest']
+        '''
+    }))
+    maps = env.platform.datasets['temperature'] = collections.OrderedDict([
+        ('t1@PERMANENT', '2019-01-01|2019-01-02|1'),
+    ])
+
+    def analysed(**kwargs):
+        events = load(jinja_env, {'pipeline': 'mypipeline'})
+        next(events)  # Location event
+        return [t for t in analyse(events, env.platform, env.history,
+                                   **kwargs)
+                if isinstance(t, TaskEvent)][0]
+
+    task = analysed()
+    assert task.changes == {'strds/temperature': ['t1@PERMANENT']}
+    assert analysed().status == TaskStatus.SKIP
+    maps['t2@PERMANENT'] = '2019-01-02|2019-01-03|1'
+    task = analysed()
+    assert task.status == TaskStatus.RUN
+    assert task.changes == {'strds/temperature': ['t2@PERMANENT']}
+    maps['t1@PERMANENT'] = '2019-01-01|2019-01-02|2'
+    assert analysed().changes == {'strds/temperature': ['t1@PERMANENT']}
+
+    # Maps are kept pending while the task is skipped
+    maps['t3@PERMANENT'] = '2019-01-03|2019-01-04|1'
+    assert analysed(skip=['0']).status == TaskStatus.SKIP
+    assert analysed().changes == {'strds/temperature': ['t3@PERMANENT']}
+    assert analysed().status == TaskStatus.SKIP
+
+
+def test_platform_cached_queries(tmpdir, monkeypatch):
+    '''Maps and the region are kept until the files of the mapset change.'''
+    from stitches import _grass
+    cellhd = tmpdir.join('loc', 'PERMANENT', 'cellhd')
+    cellhd.join('a').write('header', ensure=True)
+    gisrc = tmpdir.join('gisrc')
+    gisrc.write('GISDBASE: {}\nLOCATION_NAME: loc\nMAPSET: PERMANENT\n'
+                .format(tmpdir))
+    monkeypatch.setenv('GISRC', str(gisrc))
+    calls = []
+
+    class GrassCore(object):
+        @staticmethod
+        def read_command(module, **_):
+            calls.append(module)
+            return '\n'.join(sorted(os.listdir(str(cellhd)))).encode('utf-8')
+
+        @staticmethod
+        def region():
+            calls.append('g.region')
+            return {'n': 1}
+
+    monkeypatch.setattr(_grass, 'gcore', GrassCore)
+    platform = Platform()
+    assert platform.map_exists('raster', 'a')
+    assert platform.region_hash() == platform.region_hash()
+    platform.update()
+    assert platform.map_exists('raster', 'a')
+    assert calls == ['g.list', 'g.region']
+
+    # Maps created by a task are added, and the region read again
+    cellhd.join('b').write('header')
+    platform.update(outputs=[Resource('raster/b')])
+    assert platform.map_exists('raster', 'b')
+    platform.region_hash()
+    assert calls == ['g.list', 'g.region', 'g.region']
+
+    # Changed by another process
+    cellhd.join('c').write('header')
+    os.utime(str(cellhd), (0, 0))
+    assert platform.map_exists('raster', 'c')
+    assert calls[-1] == 'g.list'
+
+
+def test_platform_map_digest_linked(tmpdir, monkeypatch):
+    '''The digest of a linked raster changes with the file it links.'''
+    from stitches import _grass
+    mapset = tmpdir.join('PERMANENT')
+    mapset.join('cellhd', 'dem').write('header', ensure=True)
+    source = tmpdir.join('dem.tif')
+    source.write('a')
+    mapset.join('cell_misc', 'dem', 'gdal').write(
+        'file: {}\nband: 1\n'.format(source), ensure=True)
+
+    class GrassCore(object):
+        @staticmethod
+        def find_file(name, element=None):
+            return {'file': str(mapset.join(element, name))}
+
+    monkeypatch.setattr(_grass, 'gcore', GrassCore)
+    platform = Platform()
+    digest = platform.map_digest('raster', 'dem')
+    source.write('bb')
+    assert platform.map_digest('raster', 'dem') != digest